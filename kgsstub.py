@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Локальная замена API KGS для нагрузочного тестирования vpgtpd без подключения к серверу KGS
+
+from asyncio import Queue, sleep
+from random import random, uniform
+
+# Сессия пользователя заглушки
+class StubSession(object):
+  # Принимает номер сессии и логин
+  def __init__(self, sessionId, login):
+    self.id = sessionId
+    self.login = login
+    self.queue = Queue()
+    self.channels = set()
+    self.closed = False
+  # Ставит сообщение в очередь на выдачу
+  def put(self, msg):
+    if not self.closed:
+      self.queue.put_nowait(msg)
+
+# Заглушка API KGS: вход, комнаты, создание демонстраций, изменения SGF, чат и длинный опрос
+class KgsStub(object):
+  # Принимает путь API, названия комнат, задержку и разброс задержки (в секундах),
+  # долю сброшенных опросов, долю ответов с ошибкой 5xx, время длинного опроса (в секундах) и файл записи запросов
+  def __init__(self, apiPath, rooms, latency = 0, jitter = 0, dropRate = 0, errorRate = 0, pollTime = 30, recordFile = None):
+    self.apiPath = apiPath
+    self.rooms = {}
+    for i in range(0, len(rooms)):
+      self.rooms[i + 1] = rooms[i]
+    self.latency = latency
+    self.jitter = jitter
+    self.dropRate = dropRate
+    self.errorRate = errorRate
+    self.pollTime = pollTime
+    self.record = None
+    if recordFile:
+      self.record = open(recordFile, "a", encoding = "utf-8")
+    self.sessions = {}
+    self.nextSession = 1
+    self.nextChannel = 1000
+    self.games = {}
+    self.stats = {"requests": 0, "posts": 0, "polls": 0, "dropped": 0, "errors": 0, "sgfEvents": 0, "types": {}}
+  # Возвращает приложение aiohttp
+  def app(self):
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_post(self.apiPath, self.handlePost)
+    app.router.add_get(self.apiPath, self.handleGet)
+    app.router.add_get("/stats", self.handleStats)
+    app.router.add_post("/stats/reset", self.handleReset)
+    return app
+  # Записывает запрос
+  def recordRequest(self, method, session, msg):
+    from json import dumps
+    from time import time
+    self.stats["requests"] += 1
+    if msg is not None:
+      types = self.stats["types"]
+      types[msg.get("type")] = types.get(msg.get("type"), 0) + 1
+      if msg.get("type") == "KGS_SGF_CHANGE":
+        self.stats["sgfEvents"] += len(msg.get("sgfEvents", []))
+    if self.record:
+      self.record.write(dumps({"time": time(), "method": method, "session": session, "msg": msg}, ensure_ascii = False) + "\n")
+      self.record.flush()
+  # Ждет случайную задержку и решает, вернуть ли ошибку
+  async def delay(self):
+    wait = self.latency + uniform(-self.jitter, self.jitter)
+    if wait > 0:
+      await sleep(wait)
+    if random() < self.errorRate:
+      self.stats["errors"] += 1
+      return True
+    return False
+  # Возвращает сессию запроса
+  def session(self, request):
+    sessionId = request.cookies.get("JSESSIONID")
+    if sessionId is None:
+      return None
+    return self.sessions.get(sessionId)
+  # Отправляет сообщение всем сессиям, подключенным к каналу
+  def broadcast(self, channelId, msg):
+    for x in self.sessions.values():
+      if channelId in x.channels:
+        x.put(msg)
+  # Обрабатывает POST-запрос с сообщением
+  async def handlePost(self, request):
+    from aiohttp import web
+    from json import loads
+    self.stats["posts"] += 1
+    try:
+      msg = loads(await request.text())
+    except ValueError:
+      msg = None
+    session = self.session(request)
+    self.recordRequest("POST", session.id if session else None, msg)
+    if await self.delay():
+      return web.Response(status = 503, text = "Service Unavailable")
+    if not isinstance(msg, dict) or "type" not in msg:
+      return web.Response(status = 400, text = "Bad Request")
+    if msg["type"] == "LOGIN":
+      return self.login(msg)
+    if session is None or session.closed:
+      return web.Response(status = 401, text = "Not logged in")
+    self.process(session, msg)
+    return web.Response(text = "OK")
+  # Обрабатывает вход
+  def login(self, msg):
+    from aiohttp import web
+    session = StubSession(str(self.nextSession), msg.get("name", ""))
+    self.nextSession += 1
+    self.sessions[session.id] = session
+    session.put({"type": "HELLO", "versionMajor": 3, "versionMinor": 5, "versionBugfix": 0, "jsonClientBuild": "stub"})
+    session.put({"type": "LOGIN_SUCCESS", "you": {"name": session.login, "flags": ""}, "friends": [], "rooms": [], "roomCategoryChannelIds": {}})
+    session.put({"type": "ROOM_NAMES", "rooms": [{"channelId": x, "name": self.rooms[x]} for x in self.rooms]})
+    response = web.Response(text = "OK")
+    response.set_cookie("JSESSIONID", session.id)
+    return response
+  # Обрабатывает сообщение пользователя
+  def process(self, session, msg):
+    if msg["type"] == "LOGOUT":
+      session.put({"type": "LOGOUT"})
+      session.closed = True
+    elif msg["type"] == "WAKE_UP":
+      pass
+    elif msg["type"] == "CHALLENGE_CREATE":
+      channelId = self.nextChannel
+      self.nextChannel += 1
+      rules = msg.get("proposal", {}).get("rules", {})
+      game = {"channelId": channelId, "gameType": "demonstration", "roomId": msg.get("channelId"), "players": {"owner": {"name": session.login}}}
+      self.games[channelId] = {"owner": session.login, "room": msg.get("channelId"), "saved": False, "summary": game,
+        "sgfEvents": [{"type": "PROP_GROUP_ADDED", "nodeId": 0, "props": [{"name": "RULES", "size": rules.get("size", 19), "komi": rules.get("komi", 7.5), "rules": rules.get("rules", "chinese")}]}]}
+      session.put({"type": "GAME_NOTIFY", "game": game})
+      self.join(session, channelId)
+    elif msg["type"] == "JOIN_REQUEST":
+      if msg.get("channelId") in self.games:
+        self.join(session, msg["channelId"])
+      else:
+        session.put({"type": "JOIN_DENIED", "channelId": msg.get("channelId")})
+    elif msg["type"] == "KGS_SGF_CHANGE":
+      if msg.get("channelId") in self.games:
+        self.games[msg["channelId"]]["sgfEvents"].extend(msg.get("sgfEvents", []))
+        self.broadcast(msg["channelId"], {"type": "GAME_UPDATE", "channelId": msg["channelId"], "sgfEvents": msg.get("sgfEvents", [])})
+    elif msg["type"] == "CHAT":
+      self.broadcast(msg.get("channelId"), {"type": "CHAT", "channelId": msg.get("channelId"), "user": {"name": session.login}, "text": msg.get("text", "")})
+    elif msg["type"] == "GAME_LIST_ENTRY_SET_FLAGS":
+      if msg.get("channelId") in self.games:
+        self.games[msg["channelId"]]["saved"] = bool(msg.get("saved"))
+  # Подключает сессию к игре и выдает накопленные изменения SGF
+  def join(self, session, channelId):
+    game = self.games[channelId]
+    session.channels.add(channelId)
+    session.put({"type": "GAME_JOIN", "channelId": channelId, "gameSummary": game["summary"], "users": [{"name": game["owner"]}],
+      "sgfEvents": list(game["sgfEvents"])})
+    session.put({"type": "JOIN_COMPLETE", "channelId": channelId})
+  # Обрабатывает длинный опрос: выдает все накопившиеся сообщения или пустой ответ по истечении времени
+  async def handleGet(self, request):
+    from asyncio import wait_for, TimeoutError
+    from aiohttp import web
+    self.stats["polls"] += 1
+    session = self.session(request)
+    self.recordRequest("GET", session.id if session else None, None)
+    if await self.delay():
+      return web.Response(status = 502, text = "Bad Gateway")
+    if session is None or (session.closed and session.queue.empty()):
+      return web.Response(status = 401, text = "Not logged in")
+    try:
+      msgs = [await wait_for(session.queue.get(), self.pollTime)]
+    except TimeoutError:
+      return web.json_response({})
+    if random() < self.dropRate:
+      # Сообщения возвращаются в очередь и будут выданы следующим опросом
+      self.stats["dropped"] += 1
+      rest = [msgs[0]]
+      while not session.queue.empty():
+        rest.append(session.queue.get_nowait())
+      for x in rest:
+        session.queue.put_nowait(x)
+      request.transport.close()
+      return web.Response(status = 500)
+    while not session.queue.empty():
+      msgs.append(session.queue.get_nowait())
+    if session.closed and session.queue.empty():
+      del self.sessions[session.id]
+    return web.json_response({"messages": msgs})
+  # Возвращает счетчики запросов
+  async def handleStats(self, request):
+    from aiohttp import web
+    return web.json_response(self.stats)
+  # Сбрасывает счетчики запросов
+  async def handleReset(self, request):
+    from aiohttp import web
+    for x in self.stats:
+      self.stats[x] = {} if x == "types" else 0
+    return web.json_response(self.stats)
+
+if __name__ == '__main__':
+  from configparser import ConfigParser
+  from aiohttp import web
+  import sys
+  config = ConfigParser()
+  config.read(sys.argv[1])
+  host = config["Stub"]["Host"]
+  port = int(config["Stub"]["Port"])
+  apiPath = config["Stub"].get("ApiPath", "/api/access")
+  rooms = [x.strip() for x in config["Stub"]["Rooms"].split(",")]
+  latency = float(config["Stub"].get("Latency", "0"))
+  jitter = float(config["Stub"].get("Jitter", "0"))
+  dropRate = float(config["Stub"].get("DropRate", "0"))
+  errorRate = float(config["Stub"].get("ErrorRate", "0"))
+  pollTime = float(config["Stub"].get("PollTime", "30"))
+  recordFile = config["Stub"].get("RecordFile")
+  stub = KgsStub(apiPath, rooms, latency, jitter, dropRate, errorRate, pollTime, recordFile)
+  web.run_app(stub.app(), host = host, port = port)
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Нагрузочный тест турнира: запускает vpgtpd с N партиями, заглушку KGS и 2N синтетических ботов,
+# измеряет задержку сервера между ходами, скорость игры, число потоков, память и процессорное время сервера
+
+import os
+import sys
+from asyncio import sleep
+from vpgtpd import Board, taskStart
+from kgsstub import KgsStub
+
+# Возвращает перцентиль отсортированного списка
+def percentile(values, p):
+  if not values:
+    return 0
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Синтетический бот: отвечает на команды GTP и играет случайные допустимые ходы
+class BenchBot(object):
+  # Принимает номер партии, общее состояние партий, адрес сервера, идентификатор, предел числа ходов и время на ход (в секундах)
+  def __init__(self, game, games, host, port, id, maxMoves, thinkTime):
+    self.game = game
+    self.games = games
+    self.host = host
+    self.port = port
+    self.id = id
+    self.maxMoves = maxMoves
+    self.thinkTime = thinkTime
+    self.board = Board(19)
+    self.komi = 7.5
+    self.moves = 0
+    self.writer = None
+  # Подключается к серверу, повторяя попытки, пока сервер не начнет принимать соединения
+  async def connect(self, time):
+    from asyncio import open_connection
+    from time import monotonic
+    deadline = monotonic() + time
+    while True:
+      try:
+        return await open_connection(self.host, self.port)
+      except OSError:
+        if monotonic() > deadline:
+          raise
+        await sleep(0.2)
+  # Играет партию до закрытия соединения сервером
+  async def run(self, time):
+    from time import monotonic
+    reader, self.writer = await self.connect(time)
+    self.writer.write(("%s\n" % self.id).encode("utf-8"))
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        line = line.decode("utf-8").strip()
+        if not line:
+          continue
+        args = line.split()
+        id = ""
+        if args[0].isdigit():
+          id = args.pop(0)
+        if args and args[0] == "genmove":
+          state = self.games[self.game]
+          if state["lastReply"] is not None:
+            state["latency"].append(monotonic() - state["lastReply"])
+        ok, text = await self.command(args)
+        self.writer.write(("%s%s %s\n\n" % ("=" if ok else "?", id, text)).encode("utf-8"))
+        if args and args[0] == "genmove":
+          state = self.games[self.game]
+          state["lastReply"] = monotonic()
+          state["moves"] += 1
+          if state["start"] is None:
+            state["start"] = state["lastReply"]
+          state["end"] = state["lastReply"]
+        await self.writer.drain()
+        if args and args[0] == "quit":
+          break
+    except (ConnectionError, OSError):
+      pass
+    finally:
+      self.writer.close()
+  # Выполняет команду GTP, возвращает признак успеха и текст ответа
+  async def command(self, args):
+    known = {"protocol_version", "name", "version", "known_command", "list_commands", "quit", "boardsize", "komi", "clear_board",
+      "play", "genmove", "time_settings", "time_left", "final_score", "final_status_list"}
+    if not args:
+      return False, "empty command"
+    cmd = args[0]
+    try:
+      if cmd == "protocol_version":
+        return True, "2"
+      elif cmd == "name":
+        return True, "BenchBot"
+      elif cmd == "version":
+        return True, "1.0"
+      elif cmd == "known_command":
+        return True, "true" if args[1] in known else "false"
+      elif cmd == "list_commands":
+        return True, "\n".join(sorted(known))
+      elif cmd in ("quit", "time_settings", "time_left"):
+        return True, ""
+      elif cmd == "boardsize":
+        self.board = Board(int(args[1]))
+        return True, ""
+      elif cmd == "komi":
+        self.komi = float(args[1])
+        return True, ""
+      elif cmd == "clear_board":
+        self.board.clear()
+        self.moves = 0
+        return True, ""
+      elif cmd == "play":
+        if not self.board.play(self.board.parseColour(args[1]), self.board.parseVertex(args[2])):
+          return False, "illegal move"
+        self.moves += 1
+        return True, ""
+      elif cmd == "genmove":
+        if self.thinkTime > 0:
+          await sleep(self.thinkTime)
+        colour = self.board.parseColour(args[1])
+        pt = self.randomMove(colour)
+        self.board.play(colour, pt)
+        self.moves += 1
+        return True, self.board.vertex(pt)
+      elif cmd == "final_score":
+        from vpgtpd import scoreText
+        return True, scoreText(self.board.score(self.komi))
+      elif cmd == "final_status_list":
+        return True, ""
+    except (IndexError, ValueError):
+      return False, "syntax error"
+    return False, "unknown command"
+  # Выбирает случайный допустимый ход, не заполняющий собственные глаза, или пас
+  def randomMove(self, colour):
+    from random import shuffle
+    if self.moves >= self.maxMoves:
+      return None
+    board = self.board
+    empty = [pt for pt in board.points if board.board[pt] == board.EMPTY]
+    shuffle(empty)
+    for pt in empty:
+      if all(board.board[pt + x] in (colour, board.BORDER) for x in board.offsets):
+        continue
+      if board.checkMove(colour, pt) is not None:
+        return pt
+    return None
+
+# Возвращает номера процесса и всех его потомков
+def processTree(pid):
+  parents = {}
+  for x in os.listdir("/proc"):
+    if not x.isdigit():
+      continue
+    try:
+      with open("/proc/%s/stat" % x) as f:
+        parents[int(x)] = int(f.read().rsplit(")", 1)[1].split()[1])
+    except (OSError, IndexError, ValueError):
+      pass
+  tree = [pid]
+  for x in tree:
+    tree += [y for y in parents if parents[y] == x]
+  return tree
+
+# Читает из /proc суммарное число потоков и пиковую память (в килобайтах) процесса и его потомков
+def procStatus(pid):
+  threads = 0
+  rss = 0
+  for x in processTree(pid):
+    try:
+      with open("/proc/%d/status" % x) as f:
+        for line in f:
+          if line.startswith("Threads:"):
+            threads += int(line.split()[1])
+          elif line.startswith("VmHWM:"):
+            rss += int(line.split()[1])
+    except OSError:
+      pass
+  return threads, rss
+
+# Записывает настройки сервера для прогона из N партий, при нулевом порту заглушки KGS партии не транслируются
+def writeConfig(path, numGames, port, kgsPort, mainTime, demosPerAccount, boardSize, workers):
+  with open(path, "w", encoding = "utf-8") as f:
+    f.write("[Server]\nHost=127.0.0.1\nPort=%d\nReferee=builtin\nMainTime=%g\nByoyomiTime=0\nByoyomiMoves=0\nBoardSize=%d\nWorkers=%d\n" % (port, mainTime, boardSize, workers))
+    if kgsPort:
+      f.write("KgsApi=http://127.0.0.1:%d/api/access\nKgsDemosPerAccount=%d\n" % (kgsPort, demosPerAccount))
+    f.write("RoundStart=01.01.2000 00:00\n\n")
+    f.write("[RefereeSetupCommands]\ncmd1=boardsize 19\ncmd2=komi 7.5\ncmd3=clear_board\n\n")
+    f.write("[PlayerSetupCommands]\ncmd1=boardsize 19\ncmd2=komi 7.5\ncmd3=clear_board\n\n")
+    for i in range(0, numGames):
+      f.write("[Game=bench%d]\nPlayer1=Black%d\nPlayer1ID=b%d\nPlayer2=White%d\nPlayer2ID=w%d\n" % (i, i, i, i, i))
+      f.write("KGSName=bench%d\nKGSPassword=bench\nKGSRoom=Bench\n\n" % (i // demosPerAccount))
+
+# Проводит прогон из N партий и возвращает его показатели
+async def runBench(numGames, port, kgsPort, maxMoves, thinkTime, mainTime, demosPerAccount, boardSize, workers, time, serverLog):
+  from asyncio import create_subprocess_exec, gather, wait_for
+  from resource import getrusage, RUSAGE_CHILDREN
+  from subprocess import DEVNULL
+  from tempfile import mkstemp
+  from time import monotonic
+  fd, cfgPath = mkstemp(suffix = ".cfg")
+  os.close(fd)
+  writeConfig(cfgPath, numGames, port, kgsPort, mainTime, demosPerAccount, boardSize, workers)
+  games = [{"lastReply": None, "latency": [], "moves": 0, "start": None, "end": None} for i in range(0, numGames)]
+  log = open(serverLog, "a") if serverLog else DEVNULL
+  usage = getrusage(RUSAGE_CHILDREN)
+  server = await create_subprocess_exec(sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "vpgtpd.py"), cfgPath, stdout = log, stderr = log)
+  bots = []
+  for i in range(0, numGames):
+    bots.append(BenchBot(i, games, "127.0.0.1", port, "b%d" % i, maxMoves, thinkTime))
+    bots.append(BenchBot(i, games, "127.0.0.1", port, "w%d" % i, maxMoves, thinkTime))
+  tasks = [taskStart(x.run(time)) for x in bots]
+  threads = 0
+  rss = 0
+  started = monotonic()
+  while server.returncode is None and monotonic() - started < time:
+    t, r = procStatus(server.pid)
+    threads = max(threads, t)
+    rss = max(rss, r)
+    try:
+      await wait_for(server.wait(), 0.5)
+    except Exception:
+      pass
+  if server.returncode is None:
+    server.kill()
+    await server.wait()
+  await gather(*tasks, return_exceptions = True)
+  cpu = getrusage(RUSAGE_CHILDREN)
+  if serverLog:
+    log.close()
+  os.remove(cfgPath)
+  latency = sorted(x for game in games for x in game["latency"])
+  moves = sum(game["moves"] for game in games)
+  starts = [game["start"] for game in games if game["start"] is not None]
+  ends = [game["end"] for game in games if game["end"] is not None]
+  wall = max(ends) - min(starts) if starts else 0
+  return {
+    "games": numGames,
+    "moves": moves,
+    "wall": wall,
+    "movesPerSec": moves / wall if wall > 0 else 0,
+    "p50": percentile(latency, 50) * 1000,
+    "p95": percentile(latency, 95) * 1000,
+    "p99": percentile(latency, 99) * 1000,
+    "max": (latency[-1] if latency else 0) * 1000,
+    "threads": threads,
+    "rss": rss / 1024,
+    "cpu": cpu.ru_utime + cpu.ru_stime - usage.ru_utime - usage.ru_stime,
+    "exitCode": server.returncode
+  }
+
+# Проводит прогоны для всех указанных чисел партий с общей заглушкой KGS (без заглушки при нулевом порту)
+async def bench(gameCounts, port, kgsPort, maxMoves, thinkTime, mainTime, demosPerAccount, boardSize, workers, time, serverLog):
+  from aiohttp import web
+  runner = None
+  if kgsPort:
+    stub = KgsStub("/api/access", ["Bench"])
+    runner = web.AppRunner(stub.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", kgsPort)
+    await site.start()
+  print("%6s %7s %8s %9s %9s %9s %9s %9s %7s %8s %8s" % ("games", "moves", "wall,s", "moves/s", "p50,ms", "p95,ms", "p99,ms", "max,ms", "threads", "rss,MB", "cpu,s"))
+  try:
+    for numGames in gameCounts:
+      res = await runBench(numGames, port, kgsPort, maxMoves, thinkTime, mainTime, min(numGames, demosPerAccount), boardSize, workers, time, serverLog)
+      print("%6d %7d %8.2f %9.1f %9.2f %9.2f %9.2f %9.2f %7d %8.1f %8.2f" % (res["games"], res["moves"], res["wall"], res["movesPerSec"],
+        res["p50"], res["p95"], res["p99"], res["max"], res["threads"], res["rss"], res["cpu"]))
+      if res["exitCode"] != 0:
+        print("Server exited with code %s" % res["exitCode"])
+      sys.stdout.flush()
+  finally:
+    if runner is not None:
+      await runner.cleanup()
+
+if __name__ == '__main__':
+  from asyncio import run
+  from configparser import ConfigParser
+  config = ConfigParser()
+  config.read(sys.argv[1])
+  gameCounts = [int(x) for x in config["Bench"]["Games"].split(",")]
+  port = int(config["Bench"]["Port"])
+  kgsPort = int(config["Bench"]["KgsPort"])
+  maxMoves = int(config["Bench"].get("MaxMoves", "200"))
+  thinkTime = float(config["Bench"].get("ThinkTime", "0"))
+  mainTime = float(config["Bench"].get("MainTime", "3600"))
+  demosPerAccount = int(config["Bench"].get("KgsDemosPerAccount", "1"))
+  boardSize = int(config["Bench"].get("BoardSize", "19"))
+  workers = int(config["Bench"].get("Workers", "1"))
+  time = float(config["Bench"].get("Timeout", "600"))
+  serverLog = config["Bench"].get("ServerLog")
+  run(bench(gameCounts, port, kgsPort, maxMoves, thinkTime, mainTime, demosPerAccount, boardSize, workers, time, serverLog))
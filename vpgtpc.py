@@ -1,8 +1,12 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import re
 import socket
 
+# Конец ответа GTP: пустая строка
+responseEnd = re.compile(b"\n\r?\n")
+
 # Запускает функцию в новом потоке
 def threadStart(func):
   from threading import Thread
@@ -10,81 +14,592 @@ def threadStart(func):
     def __init__(self):
       Thread.__init__(self)
     def run(self):
-      func()    
+      func()
   nt = NewThread()
   nt.start()
   return nt
 
-# Отправляет данные из сети программе
-def sockToApp(sock, proc):
+# Программа игрока: процесс сохраняется между подключениями к серверу, чтобы при обрыве связи не загружать программу заново
+# Позиция на доске программы отслеживается по командам и ответам, ее отпечаток передается серверу при подключении,
+# чтобы сервер передал только недостающие ходы
+class Engine(object):
+  # Принимает командную строку программы
+  def __init__(self, cmdLine):
+    import shlex
+    from collections import deque
+    from subprocess import Popen, PIPE
+    from threading import Lock
+    self.proc = Popen(shlex.split(cmdLine), stdin = PIPE, stdout = PIPE)
+    self.stdout = self.proc.stdout.fileno()
+    self.output = b""
+    self.lock = Lock()
+    self.sock = None
+    self.generation = 0
+    self.pending = deque()
+    self.partial = b""
+    self.boardSize = 19
+    # Позиция неизвестна, пока программу не настроит сервер
+    self.moves = None
+    self.alive = True
+  # Отправляет программе команды настройки и пропускает ответы
+  def setup(self, commands):
+    for x in commands:
+      self.send(("%s\n" % x).encode("utf-8"))
+      response = self.readResponse()
+      if response is None:
+        break
+      self.complete(response)
+  # Отправляет данные программе, запоминая команды из них, чтобы сопоставить им ответы
+  # Декодируются только первые слова команды, нужные для отслеживания позиции
+  def send(self, data):
+    with self.lock:
+      lines = (self.partial + data).split(b"\n")
+      self.partial = lines.pop()
+      for x in lines:
+        words = x.split(b"#", 1)[0].split(None, 4)[:4]
+        if words and words[0].isdigit():
+          words = words[1:]
+        words = [w.decode("utf-8", "replace").lower() for w in words[:3]]
+        if words:
+          self.pending.append((self.generation, words))
+      self.proc.stdin.write(data)
+      self.proc.stdin.flush()
+  # Выделяет из прочитанного вывода программы очередной ответ, возвращает None, если ответ еще не получен полностью
+  def popResponse(self):
+    self.output = self.output.lstrip(b"\r\n")
+    end = responseEnd.search(self.output)
+    if end is None:
+      return None
+    response = self.output[:end.end()]
+    self.output = self.output[end.end():]
+    return response
+  # Читает ответ программы, возвращает None, если программа завершилась
+  def readResponse(self):
+    import os
+    response = self.popResponse()
+    while response is None:
+      chunk = os.read(self.stdout, 65536)
+      if not chunk:
+        return None
+      self.output += chunk
+      response = self.popResponse()
+    return response
+  # Читает доступный вывод программы и возвращает ответы, которые нужно передать серверу, или None, если программа завершилась
+  def readOutput(self):
+    import os
+    chunk = os.read(self.stdout, 65536)
+    if not chunk:
+      self.alive = False
+      return None
+    self.output += chunk
+    forward = []
+    response = self.popResponse()
+    while response is not None:
+      if self.complete(response):
+        forward.append(response)
+      response = self.popResponse()
+    return b"".join(forward)
+  # Обрабатывает вывод программы без подключения к серверу в течение указанного времени
+  def idle(self, time):
+    from select import select
+    from time import monotonic
+    end = monotonic() + time
+    while self.alive and monotonic() < end:
+      readable, writable, failed = select([self.stdout], [], [], end - monotonic())
+      if readable:
+        self.readOutput()
+  # Сопоставляет ответ команде и учитывает изменение позиции
+  # Возвращает True, если ответ нужно передать серверу: команда пришла по текущему подключению
+  def complete(self, response):
+    with self.lock:
+      generation, words = self.pending.popleft() if self.pending else (None, [])
+      if response[:1] == b"=":
+        value = response.split(b"\n", 1)[0][1:].decode("utf-8", "replace").split()
+        if value and value[0].isdigit():
+          value = value[1:]
+        self.apply(words, value[0].lower() if value else "")
+      return generation == self.generation and self.sock is not None
+  # Изменяет позицию по успешно выполненной команде, позиция становится неизвестной после команд, которые не отслеживаются
+  def apply(self, words, value):
+    if not words:
+      return
+    if words[0] == "boardsize" and len(words) > 1 and words[1].isdigit():
+      self.boardSize = int(words[1])
+      self.moves = []
+    elif words[0] == "clear_board":
+      self.moves = []
+    elif self.moves is None:
+      return
+    elif words[0] == "play" and len(words) > 2:
+      self.moves.append((words[1], words[2]))
+    elif words[0] in ("genmove", "kgs-genmove_cleanup") and len(words) > 1:
+      if value and value != "resign":
+        self.moves.append((words[1], value))
+    elif words[0] in ("loadsgf", "undo", "fixed_handicap", "place_free_handicap", "set_free_handicap"):
+      self.moves = None
+  # Возвращает отпечаток позиции (так же его вычисляет сервер) или None, если позиция неизвестна
+  def digest(self):
+    from hashlib import sha1
+    if self.moves is None:
+      return None
+    text = "%d;%s" % (self.boardSize, ";".join("%s %s" % (colour[:1], move) for colour, move in self.moves))
+    return sha1(text.encode("utf-8")).hexdigest()[:16]
+  # Возвращает строку идентификатора с числом ходов и отпечатком позиции
+  def idLine(self, id):
+    with self.lock:
+      digest = self.digest()
+      if digest is None:
+        return id
+      return "%s %d %s" % (id, len(self.moves), digest)
+  # Подключает программу к соединению, ответы на команды прежних подключений отбрасываются
+  def attach(self, sock):
+    with self.lock:
+      self.generation += 1
+      self.sock = sock
+      self.partial = b""
+  # Отключает программу от соединения
+  # Соединением может быть сокет или любой объект с методами write и close при работе в цикле событий
+  def detach(self):
+    with self.lock:
+      self.sock = None
+  # Отправляет ответы программы в сеть, пока программа работает
+  def relay(self, log = None):
+    import sys
+    while True:
+      response = self.readResponse()
+      if response is None:
+        break
+      sys.stdout.write(response.decode('utf-8', 'replace'))
+      sys.stdout.flush()
+      if log is not None:
+        log.write("<", response)
+      if self.complete(response):
+        with self.lock:
+          try:
+            self.sock.sendall(response)
+          except (OSError, AttributeError):
+            pass
+    with self.lock:
+      self.alive = False
+      if self.sock is not None:
+        try:
+          self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+          pass
+  # Завершает программу
+  def stop(self):
+    from subprocess import TimeoutExpired
+    if self.proc.poll() is None:
+      try:
+        print("quit")
+        self.proc.stdin.write("quit\n".encode('utf-8'))
+        self.proc.stdin.flush()
+        self.proc.wait(10)
+      except (OSError, TimeoutExpired):
+        self.proc.kill()
+
+# Журнал обмена с сервером: записывает долю sample сообщений в файл в отдельном потоке, не задерживая передачу
+class TrafficLog(object):
+  # Принимает путь к файлу и долю записываемых сообщений
+  def __init__(self, path, sample = 1):
+    from queue import Queue
+    self.path = path
+    self.sample = sample
+    self.queue = Queue(10000)
+    threadStart(self.run)
+  # Ставит сообщение в очередь на запись, при переполнении очереди сообщение пропускается
+  def write(self, direction, data):
+    from queue import Full
+    from random import random
+    from time import time
+    if self.sample < 1 and random() >= self.sample:
+      return
+    try:
+      self.queue.put_nowait((time(), direction, data))
+    except Full:
+      pass
+  # Записывает сообщения из очереди
+  def run(self):
+    with open(self.path, "a", encoding = "utf-8") as f:
+      while True:
+        msg = self.queue.get()
+        if msg is None:
+          break
+        f.write("%.3f %s %s\n" % (msg[0], msg[1], msg[2].decode("utf-8", "replace").rstrip()))
+        if self.queue.empty():
+          f.flush()
+  # Завершает запись
+  def close(self):
+    self.queue.put(None)
+
+# Отправляет данные из сети программе, возвращает True, если от сервера были получены данные
+def sockToApp(sock, engine, data = b"", log = None):
   import sys
+  received = bool(data)
   try:
-    while True:
-      data = sock.recv(4096)
-      sys.stdout.write(data.decode('utf-8'))
+    while data:
+      sys.stdout.write(data.decode('utf-8', 'replace'))
       sys.stdout.flush()
-      if not data:
-        break
-      proc.stdin.write(data)
-      proc.stdin.flush()
+      if log is not None:
+        log.write(">", data)
+      engine.send(data)
+      data = sock.recv(4096)
+      received = True
+  except OSError:
+    pass
   finally:
     sock.close()
-    print("Lost connection")
-    try:
-      print("quit")
-      proc.stdin.write("quit\n".encode('utf-8'))
-      proc.stdin.flush()
-    except:
-      proc.kill()
-
-# Отправляет данные программы в сеть
-def appToSock(sock, proc):
-  import sys
+  return received
+
+# Передает данные между сервером и программой в одном потоке без вывода на консоль и без декодирования,
+# возвращает True, если от сервера были получены данные
+def rawRelay(sock, engine, data = b"", log = None):
+  import selectors
+  received = bool(data)
+  selector = selectors.DefaultSelector()
+  selector.register(sock, selectors.EVENT_READ)
+  selector.register(engine.stdout, selectors.EVENT_READ)
   try:
-    try:
-      while True:
-        data = proc.stdout.readline()
-        sys.stdout.write(data.decode('utf-8'))
-        sys.stdout.flush()
-        if not data:
-          break
-        sock.send(data)
-    finally:
-      sock.close()
-  except:
+    while engine.alive:
+      if data:
+        if log is not None:
+          log.write(">", data)
+        engine.send(data)
+        data = b""
+      for key, events in selector.select():
+        if key.fileobj is sock:
+          data = sock.recv(65536)
+          if not data:
+            return received
+          received = True
+        else:
+          output = engine.readOutput()
+          if output:
+            if log is not None:
+              log.write("<", output)
+            sock.sendall(output)
+  except OSError:
     pass
-    
-# Поделючается к серверу
-def clientStart(host, port, cmdLine, id, setup):
-  import shlex
-  from subprocess import Popen, PIPE
-  
-  proc = Popen(shlex.split(cmdLine), stdin = PIPE, stdout = PIPE)
-  for x in setup:
-    proc.stdin.write(("%s\n" % x).encode("utf-8"))
-    proc.stdin.flush()
-    while True:
-      line = proc.stdout.readline().decode('utf-8')[:-1]
-      if line and line[-1] == '\r':
-        line = line[:-1]
-      if not line:
+  finally:
+    selector.close()
+    sock.close()
+  return received
+
+# Нарастающая задержка переподключения: от 1 до 30 секунд, попытки прекращаются, если сервер недоступен дольше limit секунд
+class Backoff(object):
+  # Принимает предельное время недоступности сервера в секундах
+  def __init__(self, limit):
+    self.limit = limit
+    self.delay = 1
+    self.failedSince = None
+  # Учитывает, были ли получены данные от сервера, и возвращает задержку до следующей попытки или None, если попытки нужно прекратить
+  def next(self, received):
+    from time import monotonic
+    if received:
+      self.delay = 1
+      self.failedSince = None
+    elif self.failedSince is None:
+      self.failedSince = monotonic()
+    elif monotonic() - self.failedSince > self.limit:
+      return None
+    delay = self.delay
+    self.delay = min(self.delay * 2, 30)
+    return delay
+
+# Возвращает адрес и порт из строки перенаправления "vpgtp-redirect <адрес> <порт>" в начале данных или None
+def redirectTarget(data):
+  line = data.split(b"\n", 1)[0].decode('utf-8', 'replace').split()
+  if len(line) != 3 or line[0] != "vpgtp-redirect":
+    return None
+  return line[1], int(line[2])
+
+# Подключается к серверу и отправляет идентификатор, при перенаправлении координатором турнира подключается к указанному узлу
+# Возвращает сокет и уже полученные от сервера данные
+def connectServer(host, port, id):
+  for i in range(0, 8):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect((host, port))
+    sock.send(("%s\n" % id).encode('utf-8'))
+    data = b""
+    while b"\n" not in data:
+      chunk = sock.recv(4096)
+      if not chunk:
         break
-  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  sock.connect((host, port))
-  sock.send(("%s\n" % id).encode('utf-8'))
-  t1 = threadStart(lambda: sockToApp(sock, proc))
-  t2 = threadStart(lambda: appToSock(sock, proc))
-  t1.join()
-  t2.join()
+      data += chunk
+    target = redirectTarget(data)
+    if target is None:
+      return sock, data
+    sock.close()
+    host, port = target
+    print("Redirected to %s:%d" % (host, port))
+  raise ValueError("too many redirects")
+
+# Подключается к серверу в цикле событий так же, как connectServer, возвращает потоки чтения и записи и уже полученные данные
+async def openServer(host, port, id):
+  from asyncio import open_connection
+  for i in range(0, 8):
+    reader, writer = await open_connection(host, port)
+    writer.write(("%s\n" % id).encode('utf-8'))
+    data = b""
+    while b"\n" not in data:
+      chunk = await reader.read(65536)
+      if not chunk:
+        break
+      data += chunk
+    target = redirectTarget(data)
+    if target is None:
+      return reader, writer, data
+    writer.close()
+    host, port = target
+    print("%s: redirected to %s:%d" % (id, host, port))
+  raise ValueError("too many redirects")
+
+# Запускает и настраивает программу
+def startEngine(cmdLine, setup):
+  engine = Engine(cmdLine)
+  engine.setup(setup)
+  return engine
+
+# Канал соединения, по которому передаются данные нескольких программ
+# Данные каждого канала передаются кадрами "vpgtp-frame <канал> <длина>\n<данные>", кадр нулевой длины закрывает канал
+class MuxChannel(object):
+  # Принимает поток записи соединения и номер канала
+  def __init__(self, writer, channel):
+    self.writer = writer
+    self.channel = channel
+    self.closed = False
+  # Отправляет данные кадром канала
+  def write(self, data):
+    if data and not self.closed and not self.writer.is_closing():
+      self.writer.write(b"vpgtp-frame %d %d\n" % (self.channel, len(data)) + data)
+  # Закрывает канал
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      if not self.writer.is_closing():
+        self.writer.write(b"vpgtp-frame %d 0\n" % self.channel)
+
+# Несколько программ в одном процессе: все программы и соединения обслуживаются одним циклом событий,
+# данные передаются без вывода на консоль. Программы, подключающиеся к одному серверу, могут использовать одно соединение
+class MultiClient(object):
+  # Принимает список программ (адрес и порт сервера, командная строка, идентификатор, команды настройки),
+  # признак передачи данных через одно соединение, предельное время недоступности сервера и журнал обмена
+  def __init__(self, entries, multiplex = False, reconnectTime = 300, log = None):
+    self.entries = entries
+    self.multiplex = multiplex
+    self.reconnectTime = reconnectTime
+    self.log = log
+    self.engines = []
+    self.muxWriters = {}
+  # Запускает программы и подключает их к серверу, завершается, когда завершились все программы
+  async def run(self):
+    from asyncio import get_running_loop, gather
+    loop = get_running_loop()
+    self.engines = await gather(*[loop.run_in_executor(None, startEngine, x[2], x[4]) for x in self.entries])
+    for i in range(0, len(self.engines)):
+      loop.add_reader(self.engines[i].stdout, self.engineOutput, i)
+    if self.multiplex:
+      groups = {}
+      for i in range(0, len(self.entries)):
+        groups.setdefault(self.entries[i][:2], []).append(i)
+      await gather(*[self.runMux(host, port, ids) for (host, port), ids in groups.items()])
+    else:
+      await gather(*[self.runEngine(i) for i in range(0, len(self.engines))])
+    for x in self.engines:
+      if x.alive:
+        loop.remove_reader(x.stdout)
+      await loop.run_in_executor(None, x.stop)
+  # Передает ответы программы в ее соединение, при завершении программы закрывает соединение
+  def engineOutput(self, i):
+    from asyncio import get_running_loop
+    engine = self.engines[i]
+    output = engine.readOutput()
+    if output is None:
+      get_running_loop().remove_reader(engine.stdout)
+      if engine.sock is not None:
+        engine.sock.close()
+      writer = self.muxWriters.get(self.entries[i][:2])
+      if writer is not None and not any(self.engines[x].alive for x in range(0, len(self.entries)) if self.entries[x][:2] == self.entries[i][:2]):
+        writer.close()
+    elif output:
+      if self.log is not None:
+        self.log.write("<", output)
+      engine.sock.write(output)
+  # Передает данные от сервера программе
+  def engineInput(self, i, data):
+    if self.log is not None:
+      self.log.write(">", data)
+    try:
+      self.engines[i].send(data)
+    except OSError:
+      pass
+  # Подключает программу к серверу отдельным соединением и переподключает при обрыве связи
+  async def runEngine(self, i):
+    from asyncio import sleep
+    host, port, cmdLine, id, setup = self.entries[i]
+    engine = self.engines[i]
+    backoff = Backoff(self.reconnectTime)
+    while engine.alive:
+      received = False
+      try:
+        reader, writer, data = await openServer(host, port, engine.idLine(id))
+        engine.attach(writer)
+        try:
+          while data:
+            received = True
+            self.engineInput(i, data)
+            data = await reader.read(65536)
+        finally:
+          engine.detach()
+          writer.close()
+        print("%s: lost connection" % id)
+      except (OSError, ValueError) as e:
+        print("%s: connection failed: %s" % (id, e))
+      delay = backoff.next(received)
+      if delay is None or not engine.alive:
+        break
+      await sleep(delay)
+  # Открывает канал программы в соединении с сервером
+  def openChannel(self, i, writer):
+    channel = MuxChannel(writer, i)
+    self.engines[i].attach(channel)
+    channel.write(("%s\n" % self.engines[i].idLine(self.entries[i][3])).encode("utf-8"))
+  # Открывает канал, закрытый сервером, после задержки
+  async def reopenChannel(self, i, writer, backoff, received):
+    from asyncio import sleep
+    delay = backoff.next(received)
+    if delay is None:
+      return
+    await sleep(delay)
+    if self.engines[i].alive and self.engines[i].sock is None and not writer.is_closing():
+      self.openChannel(i, writer)
+  # Подключает программы к серверу одним соединением и переподключает при обрыве связи
+  async def runMux(self, host, port, ids):
+    from asyncio import open_connection, sleep, ensure_future
+    backoff = Backoff(self.reconnectTime)
+    channelBackoffs = dict((i, Backoff(self.reconnectTime)) for i in ids)
+    while any(self.engines[i].alive for i in ids):
+      received = False
+      writer = None
+      try:
+        reader, writer = await open_connection(host, port)
+        self.muxWriters[(host, port)] = writer
+        writer.write(b"vpgtp-mux\n")
+        channelReceived = {}
+        for i in ids:
+          if self.engines[i].alive:
+            self.openChannel(i, writer)
+            channelReceived[i] = False
+        data = b""
+        while True:
+          while b"\n" not in data:
+            chunk = await reader.read(65536)
+            if not chunk:
+              raise ConnectionError("connection closed")
+            data += chunk
+          header, data = data.split(b"\n", 1)
+          words = header.split()
+          if len(words) != 3 or words[0] != b"vpgtp-frame":
+            raise ValueError("bad frame")
+          channel, length = int(words[1]), int(words[2])
+          while len(data) < length:
+            chunk = await reader.read(65536)
+            if not chunk:
+              raise ConnectionError("connection closed")
+            data += chunk
+          payload, data = data[:length], data[length:]
+          if channel not in channelBackoffs:
+            continue
+          if length > 0:
+            received = True
+            channelReceived[channel] = True
+            self.engineInput(channel, payload)
+          elif self.engines[channel].sock is not None:
+            self.engines[channel].sock.close()
+            self.engines[channel].detach()
+            print("%s: channel closed" % self.entries[channel][3])
+            if self.engines[channel].alive:
+              ensure_future(self.reopenChannel(channel, writer, channelBackoffs[channel], channelReceived[channel]))
+              channelReceived[channel] = False
+      except (OSError, ValueError) as e:
+        print("%s:%d: connection failed: %s" % (host, port, e))
+      finally:
+        for i in ids:
+          self.engines[i].detach()
+        if writer is not None:
+          writer.close()
+        self.muxWriters.pop((host, port), None)
+      delay = backoff.next(received)
+      if delay is None:
+        break
+      await sleep(delay)
+
+# Подключается к серверу, при обрыве связи переподключается с нарастающей задержкой, сохраняя программу запущенной
+# Завершается, когда программа завершилась (сервер отправляет quit после окончания партии) или сервер недоступен дольше reconnectTime секунд
+# В режиме raw данные передаются в одном потоке без вывода на консоль, обмен записывается в журнал log, если он указан
+def clientStart(host, port, cmdLine, id, setup, reconnectTime = 300, raw = False, log = None):
+  from time import sleep
+  engine = Engine(cmdLine)
+  engine.setup(setup)
+  if not raw:
+    threadStart(lambda: engine.relay(log))
+  backoff = Backoff(reconnectTime)
+  while engine.alive:
+    received = False
+    try:
+      sock, data = connectServer(host, port, engine.idLine(id))
+      engine.attach(sock)
+      if raw:
+        received = rawRelay(sock, engine, data, log)
+      else:
+        received = sockToApp(sock, engine, data, log)
+      engine.detach()
+      print("Lost connection")
+    except (OSError, ValueError) as e:
+      print("Connection failed: %s" % e)
+    delay = backoff.next(received)
+    if delay is None:
+      break
+    if engine.alive:
+      print("Reconnecting in %d s" % delay)
+      if raw:
+        engine.idle(delay)
+      else:
+        sleep(delay)
+  engine.stop()
+  if log is not None:
+    log.close()
 
 if __name__ == '__main__':
   from configparser import ConfigParser
   import sys
   config = ConfigParser()
   config.read(sys.argv[1])
-  host = config["Client"]["Host"]
-  port = int(config["Client"]["Port"])
-  cmd = config["Client"]["Cmd"]
-  id = config["Client"]["ID"]
-  playerSetup = list(config["Commands"].values())
-  clientStart(host, port, cmd, id, playerSetup)
\ No newline at end of file
+  client = config["Client"] if config.has_section("Client") else {}
+  reconnectTime = float(client.get("ReconnectTime", "300"))
+  log = None
+  if client.get("LogFile"):
+    log = TrafficLog(client["LogFile"], float(client.get("LogSample", "1")))
+  # Разделы [Client=<имя>] описывают несколько программ, недостающие параметры берутся из раздела [Client]
+  entries = []
+  for x in config.sections():
+    v = x.split("=")
+    if v[0] != "Client" or len(v) != 2:
+      continue
+    commands = "Commands=%s" % v[1] if config.has_section("Commands=%s" % v[1]) else "Commands"
+    entries.append((config[x].get("Host", client.get("Host")), int(config[x].get("Port", client.get("Port"))), config[x]["Cmd"],
+      config[x].get("ID", v[1]), list(config[commands].values()) if config.has_section(commands) else []))
+  if entries:
+    from asyncio import run
+    run(MultiClient(entries, client.get("Multiplex", "no") == "yes", reconnectTime, log).run())
+    if log is not None:
+      log.close()
+  else:
+    host = client["Host"]
+    port = int(client["Port"])
+    cmd = client["Cmd"]
+    id = client["ID"]
+    raw = client.get("Relay", "echo") == "raw"
+    playerSetup = list(config["Commands"].values())
+    clientStart(host, port, cmd, id, playerSetup, reconnectTime, raw, log)
@@ -1,47 +1,153 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-# Выполнение функции с таймаутом по времени (в секундах)
-def timeout(func, time, timeoutVal = "timeout"):
-  from threading import Thread
-  # Внешний поток для выполнения функции
-  class InterruptableThread(Thread):
-    def __init__(self):
-      Thread.__init__(self)
-      self.result = None
-    def run(self):
-      try:
-        self.result = func()
-      except:
-        self.result = None
-  it = InterruptableThread()
-  it.start()
-  it.join(time)
-  if it.isAlive():
+# Выполнение сопрограммы с таймаутом по времени (в секундах), по истечении времени сопрограмма отменяется
+async def timeout(coro, time, timeoutVal = "timeout"):
+  from asyncio import wait_for, TimeoutError
+  try:
+    return await wait_for(coro, time)
+  except TimeoutError:
     return timeoutVal
-  else:
-    return it.result
-
-# Запускает функцию в новом потоке
-def threadStart(func):
-  from threading import Thread
-  class NewThread(Thread):
-    def __init__(self):
-      Thread.__init__(self)
-    def run(self):
-      func()
-  nt = NewThread()
-  nt.start()
-  return nt
+  except Exception:
+    return None
+
+# Возвращает результат подсчета (перевес черных) в формате GTP
+def scoreText(score):
+  if score > 0:
+    return "B+%.1f" % score
+  elif score < 0:
+    return "W+%.1f" % -score
+  return "0"
+
+# Возвращает координаты (x, y) точки по обозначению в GTP (y отсчитывается от верхнего края) или None для паса
+def vertexToPoint(vertex, boardSize):
+  if vertex.lower() == "pass":
+    return None
+  x = ord(vertex[:1].lower()) - ord('a')
+  if x > 8:
+    x -= 1
+  return x, boardSize - int(vertex[1:])
+
+# Возвращает узел SGF с ходом
+def sgfMove(colour, move, boardSize):
+  point = vertexToPoint(move, boardSize)
+  if point is None:
+    return ";%s[]" % colour[0].upper()
+  return ";%s[%s%s]" % (colour[0].upper(), chr(ord('a') + point[0]), chr(ord('a') + point[1]))
+
+# Экранирует текст для свойства SGF
+def sgfText(text):
+  return text.replace("\\", "\\\\").replace("]", "\\]")
+
+# Возвращает имя файла партии без расширения, пригодное для любой файловой системы
+def gameFileName(gameId):
+  from hashlib import sha1
+  import re
+  return "%s-%s" % (re.sub(r"[^\w-]", "_", gameId)[:40], sha1(gameId.encode("utf-8")).hexdigest()[:12])
+
+# Возвращает отпечаток позиции: размер доски и последовательность ходов, цвет и пункт приводятся к нижнему регистру
+# Так же отпечаток вычисляет vpgtpc по командам, переданным программе
+def positionDigest(boardSize, moves):
+  from hashlib import sha1
+  text = "%d;%s" % (boardSize, ";".join("%s %s" % (colour[:1].lower(), move.lower()) for colour, move in moves))
+  return sha1(text.encode("utf-8")).hexdigest()[:16]
+
+# Возвращает команду GTP time_left, дробное время округляется вниз до целых секунд, чтобы бот не рассчитывал на лишнее время
+def timeLeftCommand(colour, time, periods):
+  from math import floor
+  return "time_left %s %d %d" % (colour, max(0, floor(time)), periods)
+
+# Округляет положительное время вниз до целых секунд, но не меньше 1
+def wholeSeconds(time):
+  from math import floor
+  return max(1, floor(time)) if time > 0 else 0
+
+# Запускает сопрограмму в цикле событий
+def taskStart(coro):
+  from asyncio import ensure_future
+  return ensure_future(coro)
+
+# Узел дерева SGF партии KGS
+class SgfNode(object):
+  __slots__ = ("nodeId", "parent", "children", "props")
+  def __init__(self, nodeId, parent):
+    self.nodeId = nodeId
+    self.parent = parent
+    self.children = []
+    self.props = {}
+
+# Дерево SGF партии KGS с индексом узлов по номеру и свойств по ключу (имя, цвет, место)
+class SgfTree(object):
+  __slots__ = ("nodes", "activeNode", "nextNode", "boardSize")
+  def __init__(self):
+    self.nodes = {0: SgfNode(0, None)}
+    self.activeNode = 0
+    self.nextNode = 1
+    self.boardSize = 19
+  # Возвращает ключ свойства
+  @staticmethod
+  def propKey(prop):
+    loc = prop.get("loc")
+    if isinstance(loc, dict):
+      loc = (loc["x"], loc["y"])
+    return prop["name"], prop.get("color"), loc
+  # Запоминает размер доски из правил партии
+  def applyRules(self, prop):
+    if prop["name"] == "RULES" and "size" in prop:
+      self.boardSize = prop["size"]
+  # Возвращает глубину узла (число ходов до него от корня)
+  def depth(self, nodeId):
+    node = self.nodes[nodeId]
+    depth = 0
+    while node.parent is not None:
+      node = node.parent
+      depth += 1
+    return depth
+  # Выделяет номер для нового узла
+  def newNodeId(self):
+    nodeId = self.nextNode
+    self.nextNode += 1
+    return nodeId
+  # Обрабатывает SGF событие
+  def apply(self, event):
+    node = self.nodes.get(event["nodeId"])
+    if node is None:
+      return
+    if event["type"] == "CHILD_ADDED":
+      child = SgfNode(event["childNodeId"], node)
+      self.nodes[child.nodeId] = child
+      if "position" in event:
+        node.children.insert(event["position"], child)
+      else:
+        node.children.append(child)
+      if child.nodeId >= self.nextNode:
+        self.nextNode = child.nodeId + 1
+    elif event["type"] == "CHILDREN_REORDERED":
+      node.children = [self.nodes[x] for x in event["children"] if x in self.nodes]
+    elif event["type"] == "ACTIVATED":
+      self.activeNode = node.nodeId
+    elif event["type"] in {"PROP_ADDED", "PROP_CHANGED"}:
+      node.props[self.propKey(event["prop"])] = event["prop"]
+      self.applyRules(event["prop"])
+    elif event["type"] == "PROP_REMOVED":
+      node.props.pop(self.propKey(event["prop"]), None)
+    elif event["type"] == "PROP_GROUP_ADDED":
+      for prop in event["props"]:
+        node.props[self.propKey(prop)] = prop
+        self.applyRules(prop)
+    elif event["type"] == "PROP_GROUP_REMOVED":
+      for prop in event["props"]:
+        node.props.pop(self.propKey(prop), None)
 
 # Позволяет подключаться к KGS и транслировать партию
 class KgsClient(object):
-  # Принимает адрес API, логин и пароль
-  def __init__(self, kgsApi, kgsName, kgsPassword):
-    from requests import Session
-    from threading import Lock, Event
-    self.session = Session()
-    self.session.keep_alive = False
+  # Принимает адрес API, логин, пароль и общий пул соединений (None для собственного пула)
+  def __init__(self, kgsApi, kgsName, kgsPassword, connector = None):
+    from asyncio import Lock
+    from collections import deque
+    self.session = None
+    self.connector = connector
+    self.demoLock = Lock()
     self.api = kgsApi
     self.login = kgsName
     self.pwd = kgsPassword
@@ -49,177 +155,124 @@ class KgsClient(object):
     self.rooms = {}
     self.games = {}
     self.channels = []
-    self.msgQueueFilter = []
-    self.msgQueue = []
-    self.queueLock = Lock()
-    self.queueFeed = Event()
+    self.waiters = {}
+    self.msgSeq = 0
+    self.recentMsgs = deque(maxlen = 64)
     self.proc = None
-    self.logMessages = 0
-    self.logLock = Lock()
-    self.msgLog = []
-    if not self.signIn():
+  # Подключается к KGS
+  async def connect(self):
+    from aiohttp import ClientSession, CookieJar, TCPConnector
+    if self.connector is None:
+      self.session = ClientSession(connector = TCPConnector(force_close = True), cookie_jar = CookieJar(unsafe = True))
+    else:
+      self.session = ClientSession(connector = self.connector, connector_owner = False, cookie_jar = CookieJar(unsafe = True))
+    if not await self.signIn():
+      await self.session.close()
       raise ValueError
   # Отключается от KGS
-  def terminate(self):
-    self.sendRequest({"type":"LOGOUT"})
-    self.proc.join()
+  async def terminate(self):
+    await self.sendRequest({"type":"LOGOUT"})
+    if self.proc:
+      await self.proc
+    await self.session.close()
   # Обрабатывает ответ
-  def processResponse(self):
-    from requests import exceptions
-    from time import sleep
+  async def processResponse(self):
+    from asyncio import TimeoutError, sleep
+    from aiohttp import ClientError, ClientTimeout
     from json import loads
     while not self.terminated:
       try:
-        req = self.session.get(self.api)
-      except exceptions.Timeout:
+        async with self.session.get(self.api, timeout = ClientTimeout(total = None)) as req:
+          status = req.status
+          content = await req.read()
+      except TimeoutError:
+        continue
+      except ClientError:
+        await sleep(1)
         continue
-      if req.status_code == 200:
-        msg = loads(req.content.decode('utf-8'))
+      if status == 200:
+        msg = loads(content.decode('utf-8'))
         if "messages" in msg:
           for x in msg["messages"]:
-            self.processMessage(x)
+            await self.processMessage(x)
+      elif status >= 500:
+        await sleep(1)
       else:
-        self.processMessage({"type": "LOGOUT"})
-  # Отправляет запрос на сервер
-  def sendRequest(self, msg):
-    from requests import exceptions
+        await self.processMessage({"type": "LOGOUT"})
+  # Отправляет запрос на сервер, при временной ошибке сервера (5xx) повторяет его несколько раз
+  async def sendRequest(self, msg, retries = 3):
+    from asyncio import TimeoutError, sleep
+    from aiohttp import ClientError, ClientTimeout
     from json import dumps
     if self.terminated:
       return None
     print("U: %s" % str(msg))
-    ret = None
-    try:
-      req = self.session.post(self.api, data = dumps(msg), timeout = 20)
-    except exceptions.Timeout:
-      return None
-    ret = req.text
-    return ret
-  # Ожидает прихода сообщения по фильтру
-  def waitForQueueMsg(self, msgFilter):
-    ret = None
-    hope = True
-    while hope and ret is None:
-      self.queueFeed.wait()
-      self.queueLock.acquire()
+    for i in range(0, retries + 1):
       try:
-        for x in self.msgQueue:
-          if msgFilter(x):
-            ret = x
-            break
-        if ret is not None:
-          self.msgQueue.remove(ret)
-        elif msgFilter not in self.msgQueueFilter:
-          hope = False
-        else:
-          self.queueFeed.clear()
-      finally:
-        self.queueLock.release()
-    return ret
-  # Отправляет запрос и ждет ответа
-  def sendRequestAndWaitAnswer(self, msg, msgFilter):
+        async with self.session.post(self.api, data = dumps(msg), timeout = ClientTimeout(total = 20)) as req:
+          if req.status < 500 or i == retries:
+            return await req.text()
+      except (TimeoutError, ClientError):
+        return None
+      await sleep(1)
+  # Отправляет запрос и ждет ответа указанного типа
+  async def sendRequestAndWaitAnswer(self, msg, msgType, channelId = None, msgFilter = None):
     if self.terminated:
       return None
-    self.startWaitMsg()
-    if self.sendRequest(msg) != "OK":
-      self.cancelWaitMsg()
+    future = self.expectMsg(msgType, channelId, msgFilter)
+    if await self.sendRequest(msg) != "OK":
+      self.cancelMsg(future)
       return None
-    return self.endWaitMsg(msgFilter)
+    return await self.waitMsg(future)
   # Логинится
-  def signIn(self):
-    return self.sendRequestAndWaitAnswer({"type": "LOGIN", "name": self.login, "password": self.pwd, "locale": "en_US"}, lambda x: x["type"] == "LOGIN_SUCCESS") is not None
+  async def signIn(self):
+    return await self.sendRequestAndWaitAnswer({"type": "LOGIN", "name": self.login, "password": self.pwd, "locale": "en_US"}, "LOGIN_SUCCESS") is not None
   # Обрабатывает сообщение
-  def processMessage(self, msg):
+  async def processMessage(self, msg):
     print("D: %s" % str(msg))
-    self.logLock.acquire()
-    try:
-      if self.logMessages > 0:
-        self.msgLog.append(msg)
-    finally:
-      self.logLock.release()
-    self.queueLock.acquire()
-    try:
-      for x in self.msgQueueFilter:
-        if x(msg):
-          self.msgQueue.append(msg)
-          self.msgQueueFilter.remove(x)
-          self.queueFeed.set()
-    finally:
-      self.queueLock.release()
+    self.dispatchMsg(msg)
     if msg["type"] == "LOGOUT":
       self.terminated = True
-      self.queueLock.acquire()
-      try:
-        self.msgQueueFilter = []
-        self.queueFeed.set()
-      finally:
-        self.queueLock.release()
+      for key in self.waiters:
+        for future, msgFilter in self.waiters[key]:
+          if not future.done():
+            future.set_result(None)
+      self.waiters = {}
     elif msg["type"] == "IDLE_WARNING":
-      self.sendRequest({"type": "WAKE_UP"})
+      await self.sendRequest({"type": "WAKE_UP"})
     elif msg["type"] == "ROOM_NAMES":
       for x in msg["rooms"]:
         self.rooms[x["channelId"]] = x["name"]
     elif msg["type"] == "GAME_JOIN":
-      game = {"nodes":{0:{"nodeId": 0, "parentNode": -1, "position": 0, "props": []}}, "activeNode": 0}
+      game = SgfTree()
       for x in msg["sgfEvents"]:
-        self.parseSgfEvent(game, x)
+        game.apply(x)
       self.games[msg["channelId"]] = game
     elif msg["type"] == "GAME_UPDATE":
       game = self.games[msg["channelId"]]
       for x in msg["sgfEvents"]:
-        self.parseSgfEvent(game, x)
+        game.apply(x)
     elif msg["type"] == "JOIN_COMPLETE":
       self.channels.append(msg["channelId"])
     elif msg["type"] == "UNJOIN":
       self.channels.remove(msg["channelId"])
-  # Ищет определенное SGF свойство
-  def findProp(self, props, prop):
-    foundProp = None
-    for x in props:
-      if x["name"] == prop["name"] and ("color" not in prop or x["color"] == prop["color"]) and ("loc" not in prop or x["loc"] == prop["loc"]):
-        foundProp = x
-        break
-    return foundProp
-  # Обрабатывает SGF событие
-  def parseSgfEvent(self, game, event):
-    node = game["nodes"][event["nodeId"]]
-    if event["type"] == "CHILD_ADDED":
-      newNode = {"nodeId": event["childNodeId"], "parentNode": node["nodeId"], "position": 0, "props": []}
-      if "position" in event:
-        newNode["position"] = event["position"]
-      game["nodes"][newNode["nodeId"]] = newNode
-    elif event["type"] == "CHILDREN_REORDERED":
-      for pos in range(0, len(event["children"])):
-        game["nodes"][event["children"][pos]]["position"] = pos
-    elif event["type"] == "ACTIVATED":
-      game["activeNode"] = node["nodeId"]
-    elif event["type"] in {"PROP_ADDED", "PROP_CHANGED"}:
-      prop = event["prop"]
-      oldProp = self.findProp(node["props"], prop)
-      if oldProp:
-        node["props"].remove(oldProp)
-      node["props"].append(prop)
-    elif event["type"] == "PROP_REMOVED":
-      prop = event["prop"]
-      node["props"].remove(self.findProp(node["props"], prop))
-    elif event["type"] == "PROP_GROUP_ADDED":
-      for prop in event["props"]:
-        oldProp = self.findProp(node["props"], prop)
-        if oldProp:
-          node["props"].remove(oldProp)
-        node["props"].append(prop)
-    elif event["type"] == "PROP_GROUP_REMOVED":
-      for prop in event["props"]:
-        node["props"].remove(self.findProp(node["props"], prop))
   # Отправляет событие в чат
-  def sendMessage(self, channelId, msg):
-    self.sendRequest({"type": "CHAT", "channelId": channelId, "text": msg})
+  async def sendMessage(self, channelId, msg):
+    await self.sendRequest({"type": "CHAT", "channelId": channelId, "text": msg})
   # Ищет комнату
   def channelIdByRoomName(self, roomName):
     return list(self.rooms.keys())[list(self.rooms.values()).index(roomName)];
-  # Создает партию для демонстрации
-  def createDemo(self, channelId, boardSize, komi, timeSystem, mainTime, byoyomiTime, byoyomiStones):
-    self.startWaitMsg()
-    game = self.sendRequestAndWaitAnswer({
+  # Создает партию для демонстрации, партии одного аккаунта создаются по очереди, чтобы не перепутать уведомления о них
+  async def createDemo(self, channelId, boardSize, komi, timeSystem, mainTime, byoyomiTime, byoyomiStones):
+    await self.demoLock.acquire()
+    try:
+      return await self.createDemoLocked(channelId, boardSize, komi, timeSystem, mainTime, byoyomiTime, byoyomiStones)
+    finally:
+      self.demoLock.release()
+  # Создает партию для демонстрации под блокировкой
+  async def createDemoLocked(self, channelId, boardSize, komi, timeSystem, mainTime, byoyomiTime, byoyomiStones):
+    since = self.msgSeq
+    game = await self.sendRequestAndWaitAnswer({
       "type": "CHALLENGE_CREATE",
       "channelId": channelId,
       "callbackKey": 0,
@@ -241,233 +294,323 @@ class KgsClient(object):
           "role": "owner",
           "name": self.login
         }]
-    }}, lambda x: x["type"] == "GAME_NOTIFY")
-    gameId = None
-    if game:
-      gameId = game["game"]["channelId"]
-    else:
-      self.cancelWaitMsg()
+    }}, "GAME_NOTIFY")
+    if not game:
       return None
-    self.endWaitMsg(lambda x: x["type"] == "GAME_JOIN" and x["channelId"] == gameId)
+    gameId = game["game"]["channelId"]
+    await self.waitMsg(self.expectMsg("GAME_JOIN", gameId, since = since))
+    if gameId in self.games:
+      self.games[gameId].boardSize = boardSize
     return gameId
-  # Обновляет информацию
-  def demoSetInfo(self, channelId, playerWhite, playerBlack, place, gameName):
-    self.sendRequest({
-      "type": "KGS_SGF_CHANGE",
-      "channelId": channelId,
-      "sgfEvents": [
-        {
-          "type": "PROP_GROUP_ADDED",
-          "nodeId": 0,
-          "props": [
-            {
-              "name": "PLAYERNAME",
-              "color": "white",
-              "text": playerWhite
-            }, {
-              "name": "PLAYERNAME",
-              "color": "black",
-              "text": playerBlack
-            }, {
-              "name": "PLACE",
-              "text": place
-            }, {
-              "name": "GAMENAME",
-              "text": gameName
-            }
-          ]
-        }
-      ]
-    })
-  # Делает ход в демонстрации
-  def demoPlayMove(self, channelId, colour, place):
-    game = self.games[channelId]
-    newNode = max(game["nodes"].keys()) + 1
-    placeSgf = None
-    if place.lower() == "pass":
-      placeSgf = "PASS"
-    else:
-      x = ord(place[:1].lower()) - ord('a')
-      y = 19 - int(place[1:])
-      if x > 8:
-        x -= 1
-      placeSgf = {"x": x, "y": y}
-    def findEvent(events, nodeId):
-      for event in events:
-        if event["type"] == "ACTIVATED" and event["nodeId"] == nodeId:
-          return True
-      return False
-    self.sendRequestAndWaitAnswer({
-      "type": "KGS_SGF_CHANGE",
-      "channelId": channelId,
-      "sgfEvents": [
-        {
-          "type": "CHILD_ADDED",
-          "nodeId": game["activeNode"],
-          "childNodeId": newNode
-        },
-        {
-          "type": "PROP_ADDED",
-          "nodeId": newNode,
-          "prop": {
-            "name": "MOVE",
-            "loc": placeSgf,
-            "color": colour
+  # Подключается к существующей партии, возвращает True при успехе
+  async def joinGame(self, channelId):
+    return await self.sendRequestAndWaitAnswer({"type": "JOIN_REQUEST", "channelId": channelId}, "GAME_JOIN", channelId) is not None
+  # Возвращает события SGF для обновления информации
+  def demoInfoEvents(self, channelId, playerWhite, playerBlack, place, gameName):
+    return [
+      {
+        "type": "PROP_GROUP_ADDED",
+        "nodeId": 0,
+        "props": [
+          {
+            "name": "PLAYERNAME",
+            "color": "white",
+            "text": playerWhite
+          }, {
+            "name": "PLAYERNAME",
+            "color": "black",
+            "text": playerBlack
+          }, {
+            "name": "PLACE",
+            "text": place
+          }, {
+            "name": "GAMENAME",
+            "text": gameName
           }
-        },
-        {
-          "type": "ACTIVATED",
-          "nodeId": newNode,
-          "prevNodeId": -1
+        ]
+      }
+    ]
+  # Выделяет номер для нового узла партии
+  def newNodeId(self, channelId):
+    return self.games[channelId].newNodeId()
+  # Возвращает события SGF для хода после указанного узла и номер нового узла
+  def demoMoveEvents(self, channelId, parentNode, colour, place):
+    newNode = self.newNodeId(channelId)
+    placeSgf = "PASS"
+    point = vertexToPoint(place, self.games[channelId].boardSize)
+    if point is not None:
+      placeSgf = {"x": point[0], "y": point[1]}
+    events = [
+      {
+        "type": "CHILD_ADDED",
+        "nodeId": parentNode,
+        "childNodeId": newNode
+      },
+      {
+        "type": "PROP_ADDED",
+        "nodeId": newNode,
+        "prop": {
+          "name": "MOVE",
+          "loc": placeSgf,
+          "color": colour
         }
-      ]
-    }, lambda x: x["type"] == "GAME_UPDATE" and x["channelId"] == channelId and findEvent(x["sgfEvents"], newNode))
-  # Перемещается по демонстрационной партии
-  def demoJumpToMove(self, channelId, moveNum):
-    moveCur = moveNum
-    nodes = self.games[channelId]["nodes"]
-    curNode = nodes[0]
-    while moveCur > 0:
-      moveCur -= 1
-      newCur = None
-      lastPos = 0
-      for node in nodes:
-        if nodes[node]["parentNode"] == curNode["nodeId"] and nodes[node]["position"] == lastPos:
-          newCur = nodes[node]
-          lastPos += 1
-      if not newCur:
+      },
+      {
+        "type": "ACTIVATED",
+        "nodeId": newNode,
+        "prevNodeId": -1
+      }
+    ]
+    return events, newNode
+  # Перемещается по демонстрационной партии, следуя последнему варианту
+  async def demoJumpToMove(self, channelId, moveNum):
+    curNode = self.games[channelId].nodes[0]
+    for i in range(0, moveNum):
+      if not curNode.children:
         break
-      else:
-        curNode = newCur
-    newNode = curNode["nodeId"]
-    if newNode == self.games[channelId]["activeNode"]:
+      curNode = curNode.children[-1]
+    newNode = curNode.nodeId
+    if newNode == self.games[channelId].activeNode:
       return()
+    await self.sendSgfEvents(channelId, [
+      {
+        "type": "ACTIVATED",
+        "nodeId": newNode,
+        "prevNodeId": -1
+      }
+    ], newNode)
+  # Возвращает события SGF для обновления информации о времени в указанном узле
+  def demoTimeLeftEvents(self, channelId, nodeId, colour, mainTime, byoyomiStones):
+    return [
+      {
+        "type": "PROP_ADDED",
+        "nodeId": nodeId,
+        "prop":
+          {
+            "name": "TIMELEFT",
+            "color": colour,
+            "float": mainTime,
+            "int": byoyomiStones
+          }
+      }
+    ]
+  # Возвращает события SGF для обновления информации о результате
+  def demoResultEvents(self, channelId, result):
+    return [
+      {
+        "type": "PROP_ADDED",
+        "nodeId": 0,
+        "prop": {
+          "name": "RESULT",
+          "text": result
+        }
+      }
+    ]
+  # Отправляет изменения SGF одним запросом, при указании узла ждет подтверждения его активации
+  async def sendSgfEvents(self, channelId, events, waitNode = None):
+    msg = {
+      "type": "KGS_SGF_CHANGE",
+      "channelId": channelId,
+      "sgfEvents": events
+    }
+    if waitNode is None:
+      await self.sendRequest(msg)
+      return
     def findEvent(events, nodeId):
       for event in events:
         if event["type"] == "ACTIVATED" and event["nodeId"] == nodeId:
           return True
       return False
-    self.sendRequestAndWaitAnswer({
-      "type": "KGS_SGF_CHANGE",
-      "channelId": channelId,
-      "sgfEvents": [
-        {
-          "type": "ACTIVATED",
-          "nodeId": newNode,
-          "prevNodeId": -1
-        }
-      ]
-    }, lambda x: x["type"] == "GAME_UPDATE" and x["channelId"] == channelId and findEvent(x["sgfEvents"], newNode))
-  # Обновляет информацию о времени
-  def demoTimeLeft(self, channelId, colour, mainTime, byoyomiStones):
-    self.sendRequest({
-      "type": "KGS_SGF_CHANGE",
-      "channelId": channelId,
-      "sgfEvents": [
-        {
-          "type": "PROP_ADDED",
-          "nodeId": self.games[channelId]["activeNode"],
-          "prop":
-            {
-              "name": "TIMELEFT",
-              "color": colour,
-              "float": mainTime,
-              "int": byoyomiStones
-            }
-        }
-      ]
-    })
-  # Обновляет информацию о результате
-  def demoSetResult(self, channelId, result):
-    self.sendRequest({
-      "type": "KGS_SGF_CHANGE",
-      "channelId": channelId,
-      "sgfEvents": [
-        {
-          "type": "PROP_ADDED",
-          "nodeId": 0,
-          "prop": {
-            "name": "RESULT",
-            "text": result
-          }
-        }
-      ]
-    })
+    await self.sendRequestAndWaitAnswer(msg, "GAME_UPDATE", channelId, lambda x: findEvent(x["sgfEvents"], waitNode))
   # Сохраняет игру на сервере
-  def saveGame(self, channelId):
-    self.sendRequest({
+  async def saveGame(self, channelId):
+    await self.sendRequest({
       "type": "GAME_LIST_ENTRY_SET_FLAGS",
       "channelId": channelId,
       "saved": True
     })
-  # Начало ожидания сообщения
-  def startWaitMsg(self):
-    self.logLock.acquire()
-    try:
-      self.logMessages += 1
-    finally:
-      self.logLock.release()
-  # Отмена ожидания сообщения
-  def cancelWaitMsg(self):
-    self.logLock.acquire()
-    try:
-      self.logMessages -= 1
-      if self.logMessages == 0:
-        self.msgLog = []
-    finally:
-      self.logLock.release()
-  # Конец ожидания сообщения
-  def endWaitMsg(self, msgFilter):
+  # Передает сообщение ожидающим его по типу и каналу и запоминает в окне последних сообщений
+  def dispatchMsg(self, msg):
+    self.msgSeq += 1
+    self.recentMsgs.append((self.msgSeq, msg))
+    key = (msg["type"], msg.get("channelId"))
+    waiters = self.waiters.get(key)
+    if not waiters:
+      return
+    rest = []
+    for future, msgFilter in waiters:
+      if future.done():
+        continue
+      if msgFilter is None or msgFilter(msg):
+        future.set_result(msg)
+      else:
+        rest.append((future, msgFilter))
+    if rest:
+      self.waiters[key] = rest
+    else:
+      del self.waiters[key]
+  # Регистрирует ожидание сообщения, при указании номера since сначала ищет среди последних сообщений после него
+  def expectMsg(self, msgType, channelId = None, msgFilter = None, since = None):
+    from asyncio import get_event_loop
+    future = get_event_loop().create_future()
+    if since is not None:
+      for seq, msg in self.recentMsgs:
+        if seq > since and msg["type"] == msgType and msg.get("channelId") == channelId and (msgFilter is None or msgFilter(msg)):
+          future.set_result(msg)
+          return future
     if self.terminated:
-      return None
-    retMsg = None
-    self.queueLock.acquire()
-    try:
-      self.msgQueueFilter.append(msgFilter)
-      self.queueFeed.clear()
-    finally:
-      self.queueLock.release()
-    self.logLock.acquire()
+      future.set_result(None)
+    else:
+      key = (msgType, channelId)
+      self.waiters[key] = [x for x in self.waiters.get(key, []) if not x[0].done()] + [(future, msgFilter)]
+    return future
+  # Отменяет ожидание сообщения
+  def cancelMsg(self, future):
+    future.cancel()
+  # Ждет сообщения не дольше указанного времени (в секундах), возвращает None при неудаче
+  async def waitMsg(self, future, time = 20):
+    if not self.proc:
+      self.proc = taskStart(self.processResponse())
+    return await timeout(future, time, None)
+
+# Общий узел подключений к KGS: один вход и один канал опроса на аккаунт, общий пул соединений для всех аккаунтов
+# Партии одного аккаунта делят подключение, пока число демонстраций не превышает разрешенное
+class KgsHub(object):
+  # Принимает адрес API и число демонстрационных партий на один аккаунт
+  def __init__(self, kgsApi, maxDemos):
+    self.api = kgsApi
+    self.maxDemos = maxDemos
+    self.connector = None
+    self.accounts = {}
+  # Возвращает подключенный клиент KGS для партии
+  async def acquire(self, kgsName, kgsPassword):
+    from asyncio import shield
+    from aiohttp import TCPConnector
+    if self.connector is None:
+      self.connector = TCPConnector(limit = 0)
+    entries = self.accounts.setdefault(kgsName, [])
+    entry = None
+    for x in entries:
+      if x["demos"] < self.maxDemos:
+        entry = x
+        break
+    if entry is None:
+      client = KgsClient(self.api, kgsName, kgsPassword, self.connector)
+      entry = {"client": client, "login": taskStart(client.connect()), "demos": 0}
+      entries.append(entry)
+    entry["demos"] += 1
     try:
-      self.logMessages -= 1
-      for msg in self.msgLog:
-        if msgFilter(msg):
-          retMsg = msg
+      await shield(entry["login"])
+    except Exception:
+      entry["demos"] -= 1
+      if entry in entries:
+        entries.remove(entry)
+      raise
+    return entry["client"]
+  # Освобождает клиент, последняя партия аккаунта отключает его от KGS
+  async def release(self, kgsClient):
+    entries = self.accounts.get(kgsClient.login, [])
+    for x in entries:
+      if x["client"] is kgsClient:
+        x["demos"] -= 1
+        if x["demos"] == 0:
+          entries.remove(x)
+          await kgsClient.terminate()
+        break
+  # Закрывает пул соединений
+  async def close(self):
+    if self.connector is not None:
+      await self.connector.close()
+
+# Очередь трансляции партии на KGS: игра только ставит события в очередь, а отправляет их отдельная задача
+# Идущие подряд изменения SGF (ход и время, результат) объединяются в один запрос KGS_SGF_CHANGE
+# Текущий узел ведется здесь, не дожидаясь подтверждения от KGS
+class KgsBroadcast(object):
+  # Принимает клиент KGS, канал демонстрационной партии, метрики и название партии для них
+  def __init__(self, kgsClient, channelId, metrics = None, name = None):
+    from asyncio import Queue
+    self.kgsClient = kgsClient
+    self.channelId = channelId
+    self.metrics = metrics
+    self.name = name
+    self.rtt = None
+    self.activeNode = kgsClient.games[channelId].activeNode
+    self.queue = Queue()
+    self.proc = taskStart(self.process())
+  # Обновляет информацию
+  def setInfo(self, playerWhite, playerBlack, place, gameName):
+    self.queue.put_nowait(("sgf", self.kgsClient.demoInfoEvents(self.channelId, playerWhite, playerBlack, place, gameName), None))
+  # Делает ход
+  def playMove(self, colour, place):
+    events, self.activeNode = self.kgsClient.demoMoveEvents(self.channelId, self.activeNode, colour, place)
+    self.queue.put_nowait(("sgf", events, self.activeNode))
+  # Обновляет информацию о времени
+  def timeLeft(self, colour, mainTime, byoyomiStones):
+    self.queue.put_nowait(("sgf", self.kgsClient.demoTimeLeftEvents(self.channelId, self.activeNode, colour, mainTime, byoyomiStones), None))
+  # Обновляет информацию о результате
+  def setResult(self, result):
+    self.queue.put_nowait(("sgf", self.kgsClient.demoResultEvents(self.channelId, result), None))
+  # Отправляет сообщение в чат
+  def sendMessage(self, msg):
+    self.queue.put_nowait(("chat", msg))
+  # Сохраняет игру на сервере
+  def saveGame(self):
+    self.queue.put_nowait(("save",))
+  # Отправляет оставшиеся события и завершает работу
+  async def close(self):
+    self.queue.put_nowait(None)
+    await self.proc
+  # Отправляет события из очереди
+  async def process(self):
+    running = True
+    while running:
+      batch = [await self.queue.get()]
+      while not self.queue.empty():
+        batch.append(self.queue.get_nowait())
+      events = []
+      waitNode = None
+      for item in batch:
+        if item is not None and item[0] == "sgf":
+          events += item[1]
+          if item[2] is not None:
+            waitNode = item[2]
+          continue
+        if events:
+          await self.sendSgfEvents(events, waitNode)
+          events = []
+          waitNode = None
+        if item is None:
+          running = False
           break
-      if self.logMessages == 0:
-        self.msgLog = []
-    finally:
-      self.logLock.release()
-    if retMsg is not None:
-      self.queueLock.acquire()
-      try:
-        if msgFilter in self.msgQueueFilter:
-          self.msgQueueFilter.remove(msgFilter)
-      finally:
-        self.queueLock.release()
-      return retMsg
-    if not self.proc:
-      self.proc = threadStart(self.processResponse)
-    retMsg = timeout(lambda: self.waitForQueueMsg(msgFilter), 20, None)
-    if retMsg is None:
-      self.queueLock.acquire()
-      try:
-        if msgFilter in self.msgQueueFilter:
-          self.msgQueueFilter.remove(msgFilter)
-          self.queueFeed.set()
-      finally:
-        self.queueLock.release()
-    return retMsg
+        elif item[0] == "chat":
+          await self.kgsClient.sendMessage(self.channelId, item[1])
+        elif item[0] == "save":
+          await self.kgsClient.saveGame(self.channelId)
+      if events:
+        await self.sendSgfEvents(events, waitNode)
+  # Отправляет объединенные изменения SGF и учитывает время их подтверждения
+  async def sendSgfEvents(self, events, waitNode):
+    from time import monotonic
+    start = monotonic()
+    await self.kgsClient.sendSgfEvents(self.channelId, events, waitNode)
+    elapsed = monotonic() - start
+    if waitNode is not None:
+      self.rtt = elapsed
+    if self.metrics is not None:
+      self.metrics.observe(self.name, "kgs_move" if waitNode is not None else "kgs_update", elapsed)
+      self.metrics.inc("vpgtp_kgs_requests_total", self.name)
 
 # Класс для управления временем игрока
 class Timer(object):
-  from math import ceil
-  ceil = staticmethod(ceil)
-  from time import time
-  time = staticmethod(time)
-  # Основное время, бееми и количество ходов за бееми
-  def __init__(self, mainTime, byoyomiTime, byoyomiMoves):
+  from time import monotonic
+  time = staticmethod(monotonic)
+  # Основное время и бееми (в секундах, допускаются дробные значения), количество ходов за бееми, возвращаемая доля задержки сети и предел возврата в секундах
+  def __init__(self, mainTime, byoyomiTime, byoyomiMoves, lagShare = 0, lagCap = 0):
     self.mainTime = mainTime
+    self.lagShare = lagShare
+    self.lagCap = lagCap
+    self.rawTime = 0
+    self.lagCredit = 0
     self.byoyomiTime = byoyomiTime
     self.byoyomiTimeCurrent = byoyomiTime
     self.byoyomiMoves = byoyomiMoves
@@ -478,18 +621,23 @@ class Timer(object):
     if self.byoyomiMoves > 0 and self.mainTime == 0 and self.byoyomiTime == 0:
       return None
     self.localTime = self.time()
-    return self.ceil(self.mainTime + self.byoyomiTimeCurrent)
+    return self.mainTime + self.byoyomiTimeCurrent
   # Возвращает время ожидания в секундах для текущего отсчета
   def sameMove(self):
     if self.byoyomiMoves > 0 and self.mainTime == 0 and self.byoyomiTime == 0:
       return None
     diffTime = self.time() - self.localTime
-    return self.ceil(self.mainTime + self.byoyomiTimeCurrent - diffTime)
-  # Пересчитывает оставшееся время и возвращает пару (Время, Число оставшихся ходов)
-  def endMove(self):
+    return self.mainTime + self.byoyomiTimeCurrent - diffTime
+  # Пересчитывает оставшееся время с возвратом части задержки сети rtt (в секундах) и возвращает пару (Время, Число оставшихся ходов)
+  def endMove(self, rtt = None):
     if self.byoyomiMoves > 0 and self.mainTime == 0 and self.byoyomiTime == 0:
       return 0, self.byoyomiMoves;
     diffTime = self.time() - self.localTime
+    self.rawTime = diffTime
+    self.lagCredit = 0
+    if rtt:
+      self.lagCredit = min(rtt * self.lagShare, self.lagCap, diffTime)
+      diffTime -= self.lagCredit
     self.mainTime -= diffTime
     if self.mainTime <= 0:
       self.byoyomiMovesCurrent -= 1
@@ -498,9 +646,9 @@ class Timer(object):
       if self.byoyomiMovesCurrent == 0 and self.byoyomiTimeCurrent > 0:
         self.byoyomiTimeCurrent = self.byoyomiTime
         self.byoyomiMovesCurrent = self.byoyomiMoves
-      return int(self.byoyomiTimeCurrent), self.byoyomiMovesCurrent
+      return self.byoyomiTimeCurrent, self.byoyomiMovesCurrent
     else:
-      return int(self.mainTime), 0
+      return self.mainTime, 0
   # Проверяет есть ли время у игрока
   def lostOnTime(self):
     if self.byoyomiMoves > 0 and self.mainTime == 0 and self.byoyomiTime == 0:
@@ -514,177 +662,759 @@ class Timer(object):
     mainTime = self.mainTime - diffTime
     if mainTime <= 0:
       byoyomiTimeCurrent = self.byoyomiTimeCurrent + mainTime
-      return int(byoyomiTimeCurrent), self.byoyomiMovesCurrent
+      return byoyomiTimeCurrent, self.byoyomiMovesCurrent
     else:
-      return int(mainTime), 0
+      return mainTime, 0
+  # Возвращает состояние часов для журнала
+  def state(self):
+    return [self.mainTime, self.byoyomiTimeCurrent, self.byoyomiMovesCurrent]
+  # Восстанавливает состояние часов из журнала
+  def restore(self, state):
+    self.mainTime, self.byoyomiTimeCurrent, self.byoyomiMovesCurrent = state
   # Возвращает пару (Время, Число оставшихся ходов) для прошлого отсчета
   def lastTime(self):
     if self.byoyomiMoves > 0 and self.mainTime == 0 and self.byoyomiTime == 0:
       return 0, self.byoyomiMoves
     if self.mainTime > 0:
-      return int(self.mainTime), 0
+      return self.mainTime, 0
+    else:
+      return self.byoyomiTimeCurrent, self.byoyomiMovesCurrent
+
+# Ответ GTP: статус ("=" или "?"), номер команды и строки ответа
+class GtpResponse(object):
+  __slots__ = ("status", "id", "body")
+  def __init__(self, status, id, body):
+    self.status = status
+    self.id = id
+    self.body = body
+  # Возвращает строки ответа, где первая строка начинается со статуса без номера команды
+  def lines(self):
+    return ["%s %s" % (self.status, self.body[0])] + self.body[1:]
+
+# Разбирает поток байтов GTP на строки и ответы, каждая строка декодируется один раз
+class GtpFramer(object):
+  # Принимает максимальный размер непрочитанных ответов в байтах и число строк, которые нужно выдать до начала ответов
+  def __init__(self, maxSize, rawLines = 0):
+    from collections import deque
+    from re import compile
+    self.header = compile(r"^([=?])(\d*)\s?(.*)$")
+    self.maxSize = maxSize
+    self.rawLines = rawLines
+    self.buf = bytearray()
+    self.scanned = 0
+    self.status = None
+    self.id = None
+    self.body = None
+    self.size = 0
+    self.queued = 0
+    self.lines = deque()
+    self.responses = deque()
+  # Добавляет полученные данные и выделяет из них завершенные строки
+  def feed(self, data):
+    self.buf += data
+    start = 0
+    with memoryview(self.buf) as view:
+      pos = self.buf.find(b"\n", self.scanned)
+      while pos >= 0:
+        end = pos
+        if end > start and self.buf[end - 1] == 13:
+          end -= 1
+        self.pushLine(str(view[start:end], "utf-8", "replace"), pos + 1 - start)
+        start = pos + 1
+        pos = self.buf.find(b"\n", start)
+    del self.buf[:start]
+    self.scanned = len(self.buf)
+    if self.maxSize and self.queued + self.size + self.scanned > self.maxSize:
+      raise ValueError("GTP response exceeds %d bytes" % self.maxSize)
+  # Обрабатывает завершенную строку
+  def pushLine(self, line, size):
+    if self.rawLines > 0:
+      self.rawLines -= 1
+      self.lines.append(line)
+    elif self.body is None:
+      if line:
+        match = self.header.match(line)
+        if match:
+          self.status = match.group(1)
+          self.id = int(match.group(2)) if match.group(2) else None
+          self.body = [match.group(3)]
+        else:
+          self.status = ""
+          self.id = None
+          self.body = [line]
+        self.size = size
+    elif line:
+      self.body.append(line)
+      self.size += size
     else:
-      return int(self.byoyomiTimeCurrent), self.byoyomiMovesCurrent
+      self.responses.append((GtpResponse(self.status, self.id, self.body), self.size))
+      self.queued += self.size
+      self.body = None
+      self.size = 0
+  # Возвращает очередную строку до начала ответов или None
+  def popLine(self):
+    if self.lines:
+      return self.lines.popleft()
+    return None
+  # Возвращает очередной полный ответ или None
+  def popResponse(self):
+    if self.responses:
+      response, size = self.responses.popleft()
+      self.queued -= size
+      return response
+    return None
 
 # Класс игрока для управления удаленным игроком
 class Player(object):
-  # Принимает класс socket в качестве параметра
-  def __init__(self, session):
-    from threading import Lock, Event
-    self.session = session
-    self.data = ""
+  # Принимает потоки чтения и записи соединения и максимальный размер ответа в качестве параметров
+  def __init__(self, reader, writer, maxResponseSize):
+    from asyncio import Event
+    from collections import OrderedDict, deque
+    self.reader = reader
+    self.writer = writer
+    self.framer = GtpFramer(maxResponseSize, 1)
     self.dead = False
-    self.lock = Lock()
     self.feedEvent = Event()
-    self.bufLock = Lock()
-    threadStart(self.process)
-    self.id = self.readLine()
+    self.nextId = 1
+    self.pending = OrderedDict()
+    self.queued = []
+    self.sent = {}
+    self.rttSamples = deque(maxlen = 8)
+    self.rtt = None
+    self.proc = None
+    self.id = None
+    self.name = None
+    self.canCleanup = False
+    self.canLoadSgf = False
+    self.local = False
+    self.catchupTime = None
+    self.position = None
+  # Получает идентификатор игрока и проверяет поддерживаемые команды одним пакетом
+  # Данные, уже прочитанные из соединения другим процессом (строка идентификатора и последующие), передаются в received
+  # После идентификатора клиент может передать число ходов и отпечаток позиции на доске программы
+  # Возможности программ запоминаются в словаре capabilities по идентификатору игрока, при переподключении программа не опрашивается
+  async def handshake(self, received = b"", capabilities = None):
+    from ipaddress import ip_address
+    if received:
+      self.framer.feed(received)
+    self.proc = taskStart(self.process())
+    words = (await self.readLine()).split()
+    self.id = words[0] if words else ""
+    if len(words) == 3 and words[1].isdigit():
+      self.position = (int(words[1]), words[2])
+    known = capabilities.get(self.id) if capabilities is not None else None
+    if known is None:
+      known = await self.probe()
+      if capabilities is not None:
+        capabilities[self.id] = known
+    self.name = known["name"]
+    self.canCleanup = known["canCleanup"]
+    self.canLoadSgf = known["canLoadSgf"]
+    # Соединение без адреса (сокет AF_UNIX или переданный дескриптор) считается удаленным
+    peer = self.writer.get_extra_info("peername")
+    try:
+      self.local = ip_address(peer[0]).is_loopback
+    except (TypeError, ValueError, IndexError):
+      self.local = False
+  # Опрашивает поддерживаемые команды одним list_commands, а если программа его не поддерживает или в списке нет обязательных команд, пакетом known_command
+  # Возвращает имя программы и поддержку необязательных команд, при отсутствии обязательной команды вызывает ValueError
+  async def probe(self):
     reqCommands = ["known_command", "name", "quit", "boardsize", "komi", "clear_board", "final_score", "final_status_list", "play", "genmove"]
-    for x in reqCommands:
-      if self.sendCommandWithTimeout("known_command %s" % x)[0].lower() != "= true":
-        raise ValueError
-    self.canCleanup = self.sendCommandWithTimeout("known_command kgs-genmove_cleanup")[0].lower() == "= true"
-    self.name = "%s %s" % (self.sendCommandWithTimeout("name")[0][2:], self.sendCommandWithTimeout("version")[0][2:])
+    optCommands = ["kgs-genmove_cleanup", "loadsgf"]
+    res = await self.sendCommandsWithTimeout(["list_commands", "name", "version"])
+    if len(res[1]) == 0 or len(res[2]) == 0:
+      raise ValueError
+    name = "%s %s" % (res[1][0][2:], res[2][0][2:])
+    known = []
+    if len(res[0]) > 0 and res[0][0][:1] == "=":
+      commands = set(x.strip().lower() for x in [res[0][0][2:]] + res[0][1:])
+      known = [x in commands for x in reqCommands + optCommands]
+    if not all(known[:len(reqCommands)]) or not known:
+      res = await self.sendCommandsWithTimeout(["known_command %s" % x for x in reqCommands + optCommands])
+      known = [len(x) > 0 and x[0].lower() == "= true" for x in res]
+    if not all(known[:len(reqCommands)]):
+      raise ValueError
+    return {"name": name, "canCleanup": known[-2], "canLoadSgf": known[-1]}
   # Осуществляет обработку
-  def process(self):
+  async def process(self):
     while not self.dead:
       try:
-        data = self.session.recv(4096)
+        data = await self.reader.read(65536)
         if not data:
-          self.dead = True
-          self.session.close()
-          self.feedEvent.set()
-          break;
-        self.bufLock.acquire()
-        try:
-          self.feedEvent.set()
-          self.data = (self.data.encode("utf-8") + data).decode("utf-8")
-        finally:
-          self.bufLock.release()
-      except:
+          break
+        self.framer.feed(data)
         self.feedEvent.set()
-        self.session.close()
-        self.dead = True
-  # Отправляет строку
-  def sendLine(self, str):
-    if not self.dead:
-      self.session.send(("%s\n" % str).encode('utf-8'))
+        response = self.framer.popResponse()
+        while response is not None:
+          self.dispatch(response)
+          response = self.framer.popResponse()
+      except Exception:
+        break
+    self.close()
+  # Передает ответ ожидающей его команде: по номеру, а если бот не вернул номер - по порядку отправки
+  # Ответ на команду, ожидание которой было отменено, отбрасывается
+  def dispatch(self, response):
+    if response.id in self.pending:
+      id, future = response.id, self.pending.pop(response.id)
+    elif self.pending:
+      id, future = self.pending.popitem(last = False)
+    else:
+      return
+    self.measureRtt(id)
+    if future.cancelled():
+      print("%s: late reply to command %d discarded" % (self.name, id))
+    elif not future.done():
+      future.set_result(response)
+  # Учитывает время от отправки до ответа для первых команд пакетов, не требующих обдумывания, задержкой считается медиана последних замеров
+  def measureRtt(self, id):
+    from time import monotonic
+    sent = self.sent.pop(id, None)
+    if sent is not None and sent[1] is not None and sent[0] not in ("genmove", "kgs-genmove_cleanup"):
+      self.rttSamples.append(monotonic() - sent[1])
+      self.rtt = sorted(self.rttSamples)[len(self.rttSamples) // 2]
+  # Закрывает соединение
+  def close(self):
+    self.dead = True
+    self.writer.close()
+    self.feedEvent.set()
+    self.queued = []
+    self.sent.clear()
+    for x in self.pending.values():
+      if not x.done():
+        x.set_result(None)
+    self.pending.clear()
+  # Отправляет программе команду quit и закрывает соединение
+  def quit(self):
+    self.queueCommand("quit")
+    self.flush()
+    self.close()
   # Получает строку
-  def readLine(self):
-    line = ""
-    self.bufLock.acquire()
-    try:
-      line = self.data
-      offset = 0
-      while True:
-        pos = line.find('\n', offset)
-        if pos >= 0:
-          self.data = line[pos + 1:]
-          line = line[:pos]
-          break
-        offset = len(line)
-        self.feedEvent.clear()
-        self.bufLock.release()
-        try:
-          self.feedEvent.wait()
-        finally:
-          self.bufLock.acquire()
-        if offset == len(self.data):
-          self.data = ""
-          break
-        line = self.data
-    finally:
-      self.bufLock.release()
-    if line and line[-1] == '\r':
-      line = line[:-1]
-    return line
-  # Отправяет команду и возвращает список строк из ответа
-  def sendCommand(self, command):
-    from re import sub
-    lines = []
-    if not self.dead:
-      self.lock.acquire()
-      try:
-        try:
-          self.sendLine(command)
-          while True:
-            lastLine = self.readLine()
-            if not lastLine:
-              break
-            lines.append(lastLine)
-        except:
-          self.dead = True
-          self.session.close()
-      finally:
-        self.lock.release()
-      if len(lines) > 0:
-        lines[0] = sub(r"^=\d+ ", "= ", lines[0])
-    return lines
-  # Отправляет команду и возвращает список строк из ответа с таймаутом
-  def sendCommandWithTimeout(self, command):
-    res = timeout(lambda: self.sendCommand(command), 10)
-    if res == "timeout":
-      self.dead = True
-      self.session.close()
-      return []
+  async def readLine(self):
+    line = self.framer.popLine()
+    while line is None and not self.dead:
+      self.feedEvent.clear()
+      await self.feedEvent.wait()
+      line = self.framer.popLine()
+    return line or ""
+  # Ставит команду с очередным номером в очередь на отправку и возвращает ожидание ответа
+  def queueCommand(self, command):
+    from asyncio import get_event_loop
+    future = get_event_loop().create_future()
+    if self.dead:
+      future.set_result(None)
+      return future
+    self.pending[self.nextId] = future
+    self.queued.append((self.nextId, "%d %s\n" % (self.nextId, command)))
+    self.sent[self.nextId] = [command.split(" ", 1)[0], None]
+    self.nextId += 1
+    return future
+  # Отправляет все команды из очереди одной записью
+  # Время отправки для замера задержки запоминается только у первой команды пакета и только если программа не занята
+  # прежними командами: ответы на остальные команды включают время выполнения предыдущих
+  def flush(self):
+    from time import monotonic
+    if self.queued and not self.dead:
+      id = self.queued[0][0]
+      if id in self.sent and len(self.pending) == len(self.queued):
+        self.sent[id][1] = monotonic()
+      self.writer.write("".join(line for id, line in self.queued).encode('utf-8'))
+    self.queued = []
+  # Отправляет пакет команд вместе с командами из очереди и возвращает списки строк из ответов
+  # При отмене ожидания ответы отменяются, но номера команд остаются ожидающими, чтобы опознать и отбросить поздние ответы
+  async def sendCommands(self, commands):
+    from asyncio import gather
+    futures = [self.queueCommand(x) for x in commands]
+    self.flush()
+    responses = await gather(*futures)
+    return [x.lines() if x is not None else [] for x in responses]
+  # Отправляет пакет команд и возвращает списки строк из ответов с таймаутом
+  async def sendCommandsWithTimeout(self, commands):
+    res = await timeout(self.sendCommands(commands), 10)
+    if res == "timeout" or res is None:
+      self.close()
+      return [[] for x in commands]
     else:
       return res
+  # Отправяет команду и возвращает список строк из ответа
+  async def sendCommand(self, command):
+    return (await self.sendCommands([command]))[0]
+  # Отправляет команду и возвращает список строк из ответа с таймаутом
+  async def sendCommandWithTimeout(self, command):
+    return (await self.sendCommandsWithTimeout([command]))[0]
 
 # Класс судьи для проверки ходов и регистрации партии
 class Referee(object):
   # Принимает командную строку и список команд GTP для настройки судьи
   def __init__(self, command, setupCommands):
-    from subprocess import Popen, PIPE
-    from threading import Lock
-    import shlex
+    from asyncio import Lock
+    self.command = command
+    self.setupCommands = setupCommands
     self.lock = Lock()
-    self.proc = Popen(shlex.split(command), stdin = PIPE, stdout = PIPE)
-    reqCommands = ["known_command", "name", "version", "quit", "boardsize", "komi", "clear_board", "final_score", "play", "move_history"]
+    self.framer = GtpFramer(None)
+    self.proc = None
+    self.name = None
+  # Запускает и настраивает судью
+  async def start(self):
+    from asyncio import create_subprocess_exec
+    from asyncio.subprocess import PIPE
+    import shlex
+    self.proc = await create_subprocess_exec(*shlex.split(self.command), stdin = PIPE, stdout = PIPE)
+    reqCommands = ["known_command", "name", "version", "quit", "boardsize", "komi", "clear_board", "final_score", "play"]
     for x in reqCommands:
-      if self.sendCommand("known_command %s" % x)[0].lower() != "= true":
+      if (await self.sendCommand("known_command %s" % x))[0].lower() != "= true":
         raise ValueError
-    self.name = "%s %s" % (self.sendCommand("name")[0][2:], self.sendCommand("version")[0][2:])
-    for x in setupCommands:
-      self.sendCommand(x)
+    self.name = "%s %s" % ((await self.sendCommand("name"))[0][2:], (await self.sendCommand("version"))[0][2:])
+    for x in self.setupCommands:
+      await self.sendCommand(x)
   # Отправляет команду и возвращает список строк из ответа
-  def sendCommand(self, command):
-    from re import sub
-    lines = []
-    self.lock.acquire()
+  async def sendCommand(self, command):
+    response = None
+    await self.lock.acquire()
     try:
       self.proc.stdin.write(('%s\n' % command).encode('utf-8'))
-      self.proc.stdin.flush()
-      while True:
-        line = self.proc.stdout.readline().decode('utf-8')[:-1]
-        if line and line[-1] == '\r':
-          line = line[:-1]
-        if not line:
+      await self.proc.stdin.drain()
+      response = self.framer.popResponse()
+      while response is None:
+        data = await self.proc.stdout.read(65536)
+        if not data:
           break
-        else:
-          lines.append(line)
+        self.framer.feed(data)
+        response = self.framer.popResponse()
     finally:
       self.lock.release()
-    if len(lines) > 0:
-      lines[0] = sub(r"^=\d+ ", "= ", lines[0])
-    return lines
-  # Вводит игрока в курс партии
-  def preparePlayer(self, player):
-    moves = self.sendCommand("move_history")
-    moves[0] = moves[0][2:]
-    if moves[0]:
-      for x in reversed(moves):
-        player.sendCommand("play %s" % x)
-  # Проверяет не закончилась ли партия (нужно ли переходить к подсчету)
-  def gameEnded(self):
-    moves = self.sendCommand("move_history")[:2]
-    moves[0] = moves[0][2:]
-    return set(x.lower() for x in moves) == set(['black pass', 'white pass'])
+    if response is None:
+      return []
+    return response.lines()
+  # Завершает работу судьи
+  async def quit(self):
+    await self.sendCommand("quit")
+    await self.proc.wait()
+  # Принимает согласованный игроками список мертвых камней, программа GTP определяет их сама
+  def setDeadStones(self, stones):
+    pass
+
+# Группа камней одного цвета и ее дамэ
+class Group(object):
+  __slots__ = ("colour", "stones", "liberties")
+  def __init__(self, colour, stones, liberties):
+    self.colour = colour
+    self.stones = stones
+    self.liberties = liberties
+
+# Доска го: массив с рамкой, группы с дамэ, хеши Зобриста для позиционного суперко и подсчет по китайским правилам
+class Board(object):
+  EMPTY = 0
+  BLACK = 1
+  WHITE = 2
+  BORDER = 3
+  letters = "ABCDEFGHJKLMNOPQRSTUVWXYZ"
+  # Принимает размер доски
+  def __init__(self, size):
+    from random import getrandbits
+    if size < 2 or size > len(self.letters):
+      raise ValueError("unacceptable size")
+    self.size = size
+    self.stride = size + 2
+    self.points = [(y + 1) * self.stride + x + 1 for y in range(size) for x in range(size)]
+    self.offsets = (1, -1, self.stride, -self.stride)
+    self.zobrist = [None, [getrandbits(64) for x in range(self.stride * self.stride)], [getrandbits(64) for x in range(self.stride * self.stride)]]
+    self.clear()
+  # Очищает доску
+  def clear(self):
+    self.board = [self.BORDER] * (self.stride * self.stride)
+    for pt in self.points:
+      self.board[pt] = self.EMPTY
+    self.groups = [None] * (self.stride * self.stride)
+    self.hash = 0
+    self.positions = {0}
+  # Возвращает цвет по его обозначению в GTP
+  def parseColour(self, colour):
+    colour = colour.lower()
+    if colour in ("b", "black"):
+      return self.BLACK
+    elif colour in ("w", "white"):
+      return self.WHITE
+    raise ValueError("invalid color")
+  # Возвращает точку по обозначению в GTP или None для паса
+  def parseVertex(self, vertex):
+    vertex = vertex.upper()
+    if vertex == "PASS":
+      return None
+    x = self.letters.find(vertex[:1])
+    if x < 0 or x >= self.size or not vertex[1:].isdigit():
+      raise ValueError("invalid coordinate")
+    y = self.size - int(vertex[1:])
+    if y < 0 or y >= self.size:
+      raise ValueError("invalid coordinate")
+    return (y + 1) * self.stride + x + 1
+  # Возвращает обозначение точки в GTP
+  def vertex(self, pt):
+    if pt is None:
+      return "PASS"
+    return "%s%d" % (self.letters[pt % self.stride - 1], self.size + 1 - pt // self.stride)
+  # Проверяет ход и возвращает список снимаемых групп и хеш новой позиции или None, если ход запрещен
+  def checkMove(self, colour, pt):
+    board = self.board
+    if board[pt] != self.EMPTY:
+      return None
+    enemy = colour ^ 3
+    captured = []
+    free = False
+    newHash = self.hash ^ self.zobrist[colour][pt]
+    for n in (pt + 1, pt - 1, pt + self.stride, pt - self.stride):
+      c = board[n]
+      if c == self.EMPTY:
+        free = True
+      elif c == colour:
+        if len(self.groups[n].liberties) > 1:
+          free = True
+      elif c == enemy:
+        group = self.groups[n]
+        if len(group.liberties) == 1 and group not in captured:
+          captured.append(group)
+          for stone in group.stones:
+            newHash ^= self.zobrist[enemy][stone]
+    if not free and not captured:
+      return None
+    if newHash in self.positions:
+      return None
+    return captured, newHash
+  # Делает ход, возвращает False, если ход запрещен
+  def play(self, colour, pt):
+    if pt is None:
+      return True
+    check = self.checkMove(colour, pt)
+    if check is None:
+      return False
+    captured, newHash = check
+    board = self.board
+    groups = self.groups
+    board[pt] = colour
+    group = Group(colour, [pt], set())
+    groups[pt] = group
+    for n in (pt + 1, pt - 1, pt + self.stride, pt - self.stride):
+      c = board[n]
+      if c == self.EMPTY:
+        group.liberties.add(n)
+      elif c == colour:
+        if groups[n] is not group:
+          group = self.merge(group, groups[n])
+      elif c != self.BORDER:
+        groups[n].liberties.discard(pt)
+    group.liberties.discard(pt)
+    for x in captured:
+      self.remove(x)
+    self.hash = newHash
+    self.positions.add(newHash)
+    return True
+  # Объединяет две группы, меньшая присоединяется к большей
+  def merge(self, first, second):
+    if len(first.stones) < len(second.stones):
+      first, second = second, first
+    for stone in second.stones:
+      self.groups[stone] = first
+    first.stones.extend(second.stones)
+    first.liberties |= second.liberties
+    return first
+  # Снимает группу с доски
+  def remove(self, group):
+    board = self.board
+    groups = self.groups
+    for stone in group.stones:
+      board[stone] = self.EMPTY
+      groups[stone] = None
+    for stone in group.stones:
+      for n in (stone + 1, stone - 1, stone + self.stride, stone - self.stride):
+        if groups[n] is not None:
+          groups[n].liberties.add(stone)
+  # Подсчитывает очки по площади без указанных мертвых камней, возвращает перевес черных с учетом коми
+  def score(self, komi, dead = ()):
+    board = list(self.board)
+    for pt in dead:
+      if board[pt] in (self.BLACK, self.WHITE):
+        board[pt] = self.EMPTY
+    area = [0, 0, 0, 0]
+    visited = bytearray(len(board))
+    for pt in self.points:
+      c = board[pt]
+      if c != self.EMPTY:
+        area[c] += 1
+      elif not visited[pt]:
+        region = 0
+        owners = 0
+        stack = [pt]
+        visited[pt] = 1
+        while stack:
+          cur = stack.pop()
+          region += 1
+          for n in (cur + 1, cur - 1, cur + self.stride, cur - self.stride):
+            c = board[n]
+            if c == self.EMPTY:
+              if not visited[n]:
+                visited[n] = 1
+                stack.append(n)
+            elif c != self.BORDER:
+              owners |= c
+        if owners in (self.BLACK, self.WHITE):
+          area[owners] += region
+    return area[self.BLACK] - area[self.WHITE] - komi
+
+# Встроенный судья: проверяет ходы по китайским правилам с позиционным суперко без внешней программы
+class LocalReferee(Referee):
+  # Принимает список команд GTP для настройки судьи
+  def __init__(self, setupCommands):
+    Referee.__init__(self, None, setupCommands)
+    self.board = Board(19)
+    self.komi = 0.0
+    self.history = []
+    self.dead = []
+    self.commands = ["protocol_version", "name", "version", "known_command", "list_commands", "quit", "boardsize", "komi", "clear_board", "play", "final_score", "move_history"]
+  # Настраивает судью
+  async def start(self):
+    self.name = "%s %s" % ((await self.sendCommand("name"))[0][2:], (await self.sendCommand("version"))[0][2:])
+    for x in self.setupCommands:
+      await self.sendCommand(x)
+  # Выполняет команду и возвращает список строк из ответа
+  async def sendCommand(self, command):
+    args = command.split()
+    if args and args[0].isdigit():
+      args = args[1:]
+    if not args:
+      return ["? empty command"]
+    cmd = args[0].lower()
+    try:
+      if cmd == "protocol_version":
+        return ["= 2"]
+      elif cmd == "name":
+        return ["= vpgtpd"]
+      elif cmd == "version":
+        return ["= builtin"]
+      elif cmd == "known_command":
+        return ["= %s" % str(args[1].lower() in self.commands).lower()]
+      elif cmd == "list_commands":
+        return ["= %s" % self.commands[0]] + self.commands[1:]
+      elif cmd == "quit":
+        return ["= "]
+      elif cmd == "boardsize":
+        self.board = Board(int(args[1]))
+        self.history = []
+        self.dead = []
+        return ["= "]
+      elif cmd == "komi":
+        self.komi = float(args[1])
+        return ["= "]
+      elif cmd == "clear_board":
+        self.board.clear()
+        self.history = []
+        self.dead = []
+        return ["= "]
+      elif cmd == "play":
+        colour = self.board.parseColour(args[1])
+        pt = self.board.parseVertex(args[2])
+        if not self.board.play(colour, pt):
+          return ["? illegal move"]
+        self.history.append("%s %s" % ("black" if colour == Board.BLACK else "white", self.board.vertex(pt)))
+        return ["= "]
+      elif cmd == "final_score":
+        return ["= %s" % scoreText(self.board.score(self.komi, self.dead))]
+      elif cmd == "move_history":
+        moves = list(reversed(self.history)) or [""]
+        return ["= %s" % moves[0]] + moves[1:]
+      else:
+        return ["? unknown command"]
+    except (IndexError, ValueError) as e:
+      return ["? %s" % (str(e) or "syntax error")]
+  # Завершает работу судьи
+  async def quit(self):
+    pass
+  # Принимает согласованный игроками список мертвых камней для подсчета
+  def setDeadStones(self, stones):
+    self.dead = []
+    for x in stones:
+      try:
+        pt = self.board.parseVertex(x)
+      except ValueError:
+        continue
+      if pt is not None:
+        self.dead.append(pt)
+
+# Запись партии в файл SGF: каждый ход дописывается на место закрывающей скобки, поэтому файл всегда остается
+# корректным, а стоимость записи хода не зависит от длины партии. Результат записывается в корневой узел в конце партии
+class SgfRecord(object):
+  # Принимает путь к файлу, размер доски, коми, имена черного и белого игроков и название партии
+  def __init__(self, path, boardSize, komi, playerBlack, playerWhite, gameName):
+    from datetime import date
+    self.path = path
+    self.boardSize = boardSize
+    self.root = "(;FF[4]GM[1]CA[UTF-8]AP[vpgtpd]RU[Chinese]SZ[%d]KM[%g]PB[%s]PW[%s]GN[%s]DT[%s]" % (boardSize, komi,
+      sgfText(playerBlack), sgfText(playerWhite), sgfText(gameName), date.today().isoformat())
+    self.nodes = []
+    self.file = None
+  # Начинает запись с уже сделанными ходами
+  def begin(self, moves):
+    self.nodes = [sgfMove(colour, move, self.boardSize) for colour, move in moves]
+    self.file = open(self.path, "wb")
+    self.file.write(("".join([self.root] + self.nodes) + ")").encode("utf-8"))
+    self.file.flush()
+  # Дописывает ход с оставшимся временем, числом ходов в периоде байоми и временем обдумывания
+  def playMove(self, colour, move, time, periods, thinkTime):
+    node = "%s%sL[%.3f]" % (sgfMove(colour, move, self.boardSize), colour[0].upper(), time)
+    if periods > 0:
+      node += "O%s[%d]" % (colour[0].upper(), periods)
+    node += "C[think %.3f s]" % thinkTime
+    self.nodes.append(node)
+    self.file.seek(-1, 2)
+    self.file.write((node + ")").encode("utf-8"))
+    self.file.flush()
+  # Записывает результат и закрывает файл
+  def close(self, result):
+    import os
+    self.file.close()
+    with open(self.path + ".tmp", "wb") as f:
+      f.write(("".join([self.root, "RE[%s]" % sgfText(result)] + self.nodes) + ")").encode("utf-8"))
+    os.replace(self.path + ".tmp", self.path)
+
+# Журнал партий: каждая партия дописывает записи о ходах, часах, игроках и результате в свой файл,
+# запись на диск (fsync) выполняется пакетами не чаще, чем раз в interval секунд
+# Каждые snapshotMoves ходов сохраняется снимок состояния партии, восстановление читает снимок и хвост журнала после него
+class Journal(object):
+  # Принимает каталог журнала, ключ раунда, интервал записи на диск (в секундах) и число ходов между снимками
+  def __init__(self, directory, roundKey, interval = 0.05, snapshotMoves = 50):
+    import os
+    os.makedirs(directory, exist_ok = True)
+    self.directory = directory
+    self.roundKey = roundKey
+    self.interval = interval
+    self.snapshotMoves = snapshotMoves
+    self.files = {}
+    self.states = {}
+    self.dirty = set()
+    self.flusher = None
+  # Возвращает путь к файлу партии с указанным расширением
+  def path(self, gameId, ext):
+    import os
+    return os.path.join(self.directory, "%s.%s" % (gameFileName(gameId), ext))
+  # Возвращает пустое состояние партии
+  @staticmethod
+  def emptyState():
+    return {"moves": [], "passes": 0, "cleanupMode": False, "result": "", "players": {}}
+  # Применяет запись журнала к состоянию партии
+  @staticmethod
+  def apply(state, record):
+    colours = ["black", "white"]
+    if record["t"] == "start":
+      state.update(record)
+      del state["t"]
+    elif record["t"] == "kgs":
+      state["kgsGame"] = record["kgsGame"]
+    elif record["t"] == "move":
+      state["moves"].append([record["colour"], record["move"]])
+      state["passes"] = state["passes"] + 1 if record["move"] == "pass" else 0
+      state["timers"][colours.index(record["colour"])] = record["clock"]
+    elif record["t"] == "cleanup":
+      state["cleanupMode"] = True
+    elif record["t"] == "join":
+      state["players"][record["colour"]] = record["player"]
+    elif record["t"] == "leave":
+      state["players"].pop(record["colour"], None)
+    elif record["t"] == "result":
+      state["result"] = record["result"]
+      state["timers"] = record["timers"]
+  # Загружает состояние партии из снимка и журнала, возвращает None, если журнала этого раунда нет
+  def load(self, gameId):
+    from json import loads
+    state = None
+    offset = 0
+    try:
+      with open(self.path(gameId, "snap"), encoding = "utf-8") as f:
+        snapshot = loads(f.read())
+      if snapshot["round"] == self.roundKey:
+        offset = snapshot.pop("offset")
+        state = snapshot
+    except (OSError, ValueError, KeyError):
+      pass
+    try:
+      with open(self.path(gameId, "journal"), "rb") as f:
+        f.seek(offset)
+        for line in f:
+          if not line.endswith(b"\n"):
+            break
+          record = loads(line.decode("utf-8"))
+          if record["t"] == "start":
+            state = self.emptyState()
+          if state is not None:
+            self.apply(state, record)
+    except (OSError, ValueError, KeyError):
+      pass
+    if state is None or state.get("round") != self.roundKey:
+      return None
+    self.states[gameId] = state
+    return state
+  # Начинает журнал партии заново
+  def begin(self, gameId, colours, boardSize, komi, kgsGame, timers):
+    self.states[gameId] = self.emptyState()
+    if gameId in self.files:
+      self.files.pop(gameId).close()
+    self.files[gameId] = open(self.path(gameId, "journal"), "wb")
+    self.append(gameId, {"t": "start", "round": self.roundKey, "colours": colours, "boardSize": boardSize, "komi": komi, "kgsGame": kgsGame, "timers": timers})
+  # Дописывает запись в журнал партии, после записи результата журнал не изменяется
+  def append(self, gameId, record):
+    from asyncio import get_event_loop
+    from json import dumps
+    if self.states[gameId]["result"]:
+      return
+    f = self.files.get(gameId)
+    if f is None:
+      f = self.files[gameId] = open(self.path(gameId, "journal"), "ab")
+    f.write((dumps(record, ensure_ascii = False) + "\n").encode("utf-8"))
+    f.flush()
+    state = self.states[gameId]
+    self.apply(state, record)
+    self.dirty.add(gameId)
+    if self.flusher is None:
+      self.flusher = get_event_loop().call_later(self.interval, self.sync)
+    if record["t"] == "move" and len(state["moves"]) % self.snapshotMoves == 0:
+      self.snapshot(gameId)
+  # Записывает на диск накопленные записи всех партий
+  def sync(self):
+    import os
+    for x in self.dirty:
+      if x in self.files:
+        os.fsync(self.files[x].fileno())
+    self.dirty.clear()
+    self.flusher = None
+  # Сохраняет снимок состояния партии
+  def snapshot(self, gameId):
+    from json import dumps
+    import os
+    snapshot = dict(self.states[gameId])
+    snapshot["offset"] = self.files[gameId].tell()
+    tmp = self.path(gameId, "snap.tmp")
+    with open(tmp, "w", encoding = "utf-8") as f:
+      f.write(dumps(snapshot, ensure_ascii = False))
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp, self.path(gameId, "snap"))
+  # Записывает на диск и закрывает журнал партии
+  def close(self, gameId):
+    import os
+    f = self.files.pop(gameId, None)
+    if f is not None:
+      os.fsync(f.fileno())
+      f.close()
+    self.dirty.discard(gameId)
 
 # Класс игры
+# Состояния партии (state): waiting - ожидание подключения игрока, который должен ходить, thinking - ожидание хода,
+# applying - применение хода, scoring - подсчет, finished - партия закончена. Замок playerBusy удерживается только
+# в состояниях applying и scoring, поэтому игроки подключаются и вводятся в курс партии, пока соперник обдумывает ход.
+# Подключение к партии и ее начало решаются по состоянию: в состоянии finished игроки не принимаются, а игра не начинается
 class Game(object):
-  # Принимает командную строку судью, команды для его настройки, API-адрес, комнату, логин и пароль KGS, заголовок игры, имена ботов, основное время, байоми и число ходов за байоми
-  def __init__(self, referee, setupCommands, kgsApi, kgsRoom, kgsNick, kgsPwd, kgsTitle, names, ids, mainTime, byoyomiTime, byoyomiMoves):
-    from threading import Lock, Event
+  states = ("waiting", "thinking", "applying", "scoring", "finished")
+  # Принимает командную строку судьи (None для встроенного судьи), команды для его настройки, узел подключений, комнату, логин и пароль KGS, заголовок игры, имена ботов, основное время, байоми, число ходов за байоми, командную строку судьи для перепроверки результата, метрики, возвращаемую долю задержки сети, предел возврата, размер доски, коми, журнал партий и каталог для записей SGF
+  # Без узла подключений (None) партия не транслируется на KGS
+  def __init__(self, referee, setupCommands, kgsHub, kgsRoom, kgsNick, kgsPwd, kgsTitle, names, ids, mainTime, byoyomiTime, byoyomiMoves, refereeCheck = None, metrics = None, lagShare = 0, lagCap = 0, boardSize = 19, komi = 7.5, journal = None, sgfDir = None):
+    from asyncio import Lock, Event
     from random import randint
     self.name = kgsTitle
     self.colour = None
@@ -692,61 +1422,237 @@ class Game(object):
     self.timers = []
     self.players = {}
     self.playerColours = {}
+    self.playerNames = {}
     self.playerEvents = {'black': Event(), 'white': Event()}
     self.playerBusy = Lock()
+    self.joining = {}
+    self.state = "waiting"
     self.result = ""
     self.cleanupMode = False
-    self.referee = Referee(referee, setupCommands)
-    self.kgsClient = KgsClient(kgsApi, kgsNick, kgsPwd)
-    timeMode = "absolute"
-    if byoyomiMoves > 0:
-      timeMode = "canadian"
-    self.kgsGame = self.kgsClient.createDemo(self.kgsClient.channelIdByRoomName(kgsRoom), 19, 7.5, timeMode, mainTime, byoyomiTime, byoyomiMoves)
+    self.moves = []
+    self.passes = 0
+    self.boardSize = boardSize
+    self.komi = komi
+    setupCommands = self.setupCommands(setupCommands)
+    if referee is None:
+      self.referee = LocalReferee(setupCommands)
+    else:
+      self.referee = Referee(referee, setupCommands)
+    self.refereeSetup = setupCommands
+    self.refereeCheck = refereeCheck
+    self.metrics = metrics if metrics is not None else Metrics()
+    self.journal = journal
+    self.sgfDir = sgfDir
+    self.sgfRecord = None
+    self.kgsHub = kgsHub
+    self.kgsClient = None
+    self.kgsNick = kgsNick
+    self.kgsPwd = kgsPwd
+    self.kgsRoom = kgsRoom
+    self.kgsGame = None
+    self.broadcast = None
+    self.mainTime = mainTime
+    self.byoyomiTime = byoyomiTime
+    self.byoyomiMoves = byoyomiMoves
     colour = randint(0,1)
-    playerWhite = ""
-    playerBlack = ""
     for x in range(0, len(ids)):
       print("%s: %s - %s" % (self.name, names[x], self.colours[colour]))
-      playerName = names[x]
-      if colour == 0:
-        playerBlack = playerName[:10]
-      else:
-        playerWhite = playerName[:10]
       self.playerColours[ids[x]] = self.colours[colour]
-      self.timers.append(Timer(mainTime, byoyomiTime, byoyomiMoves))
+      self.playerNames[ids[x]] = names[x]
+      self.timers.append(Timer(mainTime, byoyomiTime, byoyomiMoves, lagShare, lagCap))
       colour ^= 1
-    self.kgsClient.demoSetInfo(self.kgsGame, playerWhite, playerBlack, "vpgtpd server", self.name)
-    for x in range(0, len(ids)):
-      self.kgsClient.sendMessage(self.kgsGame, "Player: %s - %s" % (names[x], self.playerColours[ids[x]]))
-    self.kgsClient.sendMessage(self.kgsGame, "Referee: %s" % self.referee.name)
+  # Запускает судью и создает трансляцию на KGS
+  async def setup(self):
+    from time import monotonic
+    startTime = monotonic()
+    state = None
+    if self.journal is not None:
+      state = self.journal.load(self.name)
+    if state is not None and state["result"]:
+      self.result = state["result"]
+      print("%s: already finished, result %s" % (self.name, self.result))
+      self.state = "finished"
+      return
+    if state is not None:
+      self.restore(state)
+    await self.referee.start()
+    for x in self.moves:
+      await self.referee.sendCommand("play %s %s" % x)
+    if self.sgfDir is not None:
+      import os
+      os.makedirs(self.sgfDir, exist_ok = True)
+      self.sgfRecord = SgfRecord(os.path.join(self.sgfDir, gameFileName(self.name) + ".sgf"), self.boardSize, self.komi,
+        self.playerName("black"), self.playerName("white"), self.name)
+      self.sgfRecord.begin(self.moves)
+    if self.kgsHub is None:
+      pass
+    elif state is not None and state["kgsGame"] is not None and await self.joinKgs(state["kgsGame"]):
+      tree = self.kgsClient.games[self.kgsGame]
+      for colour, move in self.moves[tree.depth(tree.activeNode):]:
+        self.broadcast.playMove(colour, move)
+      self.broadcast.sendMessage("Game resumed after server restart")
+    else:
+      self.kgsClient = await self.kgsHub.acquire(self.kgsNick, self.kgsPwd)
+      await self.createDemo()
+      for colour, move in self.moves:
+        self.broadcast.playMove(colour, move)
+    if state is None:
+      if self.journal is not None:
+        self.journal.begin(self.name, self.playerColours, self.boardSize, self.komi, self.kgsGame, [x.state() for x in self.timers])
+    else:
+      if self.kgsGame != state["kgsGame"]:
+        self.record({"t": "kgs", "kgsGame": self.kgsGame})
+      print("%s: resumed from journal at move %d in %.3f s" % (self.name, len(self.moves), monotonic() - startTime))
+  # Восстанавливает цвета игроков, ходы и часы из журнала
+  def restore(self, state):
+    self.playerColours = state["colours"]
+    for x in self.playerColours:
+      print("%s: %s - %s" % (self.name, self.playerNames[x], self.playerColours[x]))
+    self.moves = [tuple(x) for x in state["moves"]]
+    self.passes = state["passes"]
+    self.cleanupMode = state["cleanupMode"]
+    for i in range(0, 2):
+      self.timers[i].restore(state["timers"][i])
+  # Подключается к прежней демонстрации на KGS
+  async def joinKgs(self, kgsGame):
+    self.kgsClient = await self.kgsHub.acquire(self.kgsNick, self.kgsPwd)
+    if not await self.kgsClient.joinGame(kgsGame):
+      await self.kgsHub.release(self.kgsClient)
+      return False
+    self.kgsGame = kgsGame
+    self.broadcast = KgsBroadcast(self.kgsClient, self.kgsGame, self.metrics, self.name)
+    return True
+  # Возвращает имя игрока указанного цвета
+  def playerName(self, colour):
+    for x in self.playerColours:
+      if self.playerColours[x] == colour:
+        return self.playerNames[x]
+    return ""
+  # Дописывает запись в журнал партии
+  def record(self, record):
+    if self.journal is not None:
+      self.journal.append(self.name, record)
+  # Создает демонстрацию на KGS и трансляцию в нее
+  async def createDemo(self):
+    timeMode = "absolute"
+    if self.byoyomiMoves > 0:
+      timeMode = "canadian"
+    self.kgsGame = await self.kgsClient.createDemo(self.kgsClient.channelIdByRoomName(self.kgsRoom), self.boardSize, self.komi, timeMode, self.mainTime, self.byoyomiTime, self.byoyomiMoves)
+    self.broadcast = KgsBroadcast(self.kgsClient, self.kgsGame, self.metrics, self.name)
+    self.broadcast.setInfo(self.playerName("white")[:10], self.playerName("black")[:10], "vpgtpd server", self.name)
+    for x in self.playerColours:
+      self.broadcast.sendMessage("Player: %s - %s" % (self.playerNames[x], self.playerColours[x]))
+    self.broadcast.sendMessage("Referee: %s" % self.referee.name)
   # Пытается сделать ход, судья его проверяет и записывает
-  def attemptMove(self, move):
-    r = self.referee.sendCommand("play %s %s" % (self.colours[self.colour], move))
+  async def attemptMove(self, move):
+    r = await self.metrics.timed(self.name, "referee_play", self.referee.sendCommand("play %s %s" % (self.colours[self.colour], move)))
+    if not r:
+      raise RuntimeError("referee has stopped")
     if r[0][:2] == "= ":
+      self.moves.append((self.colours[self.colour], move))
+      if move == "pass":
+        self.passes += 1
+      else:
+        self.passes = 0
+      self.record({"t": "move", "colour": self.colours[self.colour], "move": move, "clock": self.timers[self.colour].state()})
       self.removeDeadPlayers()
       for x in self.players:
         if x != self.colours[self.colour]:
-          self.players[x].sendCommandWithTimeout("play %s %s" % (self.colours[self.colour], move))
+          self.metrics.timeFuture(self.name, "relay_play", self.players[x].queueCommand("play %s %s" % (self.colours[self.colour], move)))
       return True
     else:
       return False
+  # Возвращает запись первых count ходов партии (всех, если count не указан) в формате SGF
+  def sgf(self, count = None):
+    nodes = ["(;FF[4]GM[1]CA[UTF-8]RU[Chinese]SZ[%d]KM[%g]" % (self.boardSize, self.komi)]
+    for colour, move in self.moves[:count]:
+      nodes.append(sgfMove(colour, move, self.boardSize))
+    nodes.append(")")
+    return "".join(nodes)
+  # Возвращает команды настройки с размером доски и коми этой партии вместо указанных в них
+  def setupCommands(self, commands):
+    own = ["boardsize %d" % self.boardSize, "komi %g" % self.komi]
+    return own + [x for x in commands if x.split(" ", 1)[0].lower() not in ("boardsize", "komi")]
+  # Возвращает команды time_left с текущим временем обоих игроков
+  def clockCommands(self):
+    clocks = []
+    if self.colour is not None:
+      time, periods = self.timers[self.colour].currentTime()
+      clocks.append(timeLeftCommand(self.colours[self.colour], time, periods))
+      time, periods = self.timers[self.colour ^ 1].lastTime()
+      clocks.append(timeLeftCommand(self.colours[self.colour ^ 1], time, periods))
+    return clocks
+  # Вводит игрока в курс первых count ходов партии: настраивает его и передает ходы одним пакетом команд
+  # Игроку на этой же машине, который поддерживает loadsgf, позиция передается через временный файл SGF
+  # Если отпечаток непустой позиции программы совпадает с началом партии, позиция не сбрасывается: передаются
+  # команды настройки, кроме boardsize и clear_board, и только недостающие ходы
+  async def preparePlayer(self, player, setupCommands, count):
+    from tempfile import NamedTemporaryFile
+    from time import monotonic
+    from os import unlink
+    startTime = monotonic()
+    setupCommands = self.setupCommands(setupCommands)
+    plays = ["play %s %s" % x for x in self.moves[:count]]
+    loaded = False
+    warm = player.position is not None and 0 < player.position[0] <= count and positionDigest(self.boardSize, self.moves[:player.position[0]]) == player.position[1]
+    if warm:
+      plays = plays[player.position[0]:]
+      keep = [x for x in setupCommands if x.split(" ", 1)[0].lower() not in ("boardsize", "clear_board")]
+      await player.sendCommandsWithTimeout(keep + plays)
+    elif plays and player.canLoadSgf and player.local:
+      with NamedTemporaryFile("w", encoding = "utf-8", suffix = ".sgf", delete = False) as sgfFile:
+        sgfFile.write(self.sgf(count))
+      try:
+        res = await player.sendCommandsWithTimeout(list(setupCommands) + ["loadsgf %s" % sgfFile.name])
+        reply = res[len(setupCommands)]
+        loaded = len(reply) > 0 and reply[0][:1] == "="
+      finally:
+        unlink(sgfFile.name)
+      if not loaded and not player.dead:
+        await player.sendCommandsWithTimeout(["clear_board"] + plays)
+    else:
+      await player.sendCommandsWithTimeout(list(setupCommands) + plays)
+    player.catchupTime = monotonic() - startTime
+    print("%s: catch-up %s, %d moves in %.3f s%s" % (self.name, player.name, len(plays), player.catchupTime, " (loadsgf)" if loaded else " (warm)" if warm else ""))
+  # Подключает игрока: вводит его в курс партии, не задерживая ход соперника, затем под замком передает ходы,
+  # сделанные за это время, и текущее время и добавляет игрока в партию
+  # Возвращает False, если игрок этого цвета уже подключен или подключается, партия закончена или игрок отключился
+  async def join(self, player, setupCommands):
+    colour = self.playerColours[player.id]
+    self.removeDeadPlayers()
+    if colour in self.players or colour in self.joining or self.state == "finished":
+      return False
+    self.joining[colour] = player
+    try:
+      count = len(self.moves)
+      await self.preparePlayer(player, setupCommands, count)
+      async with self.playerBusy:
+        if player.dead or self.state == "finished":
+          return False
+        for x in ["play %s %s" % x for x in self.moves[count:]] + self.clockCommands():
+          player.queueCommand(x)
+        player.flush()
+        self.players[colour] = player
+        self.record({"t": "join", "colour": colour, "player": player.name})
+        self.playerEvents[colour].set()
+      return True
+    finally:
+      del self.joining[colour]
+  # Проверяет не закончилась ли партия (нужно ли переходить к подсчету)
+  def gameEnded(self):
+    return self.passes >= 2
   # Ждет хода от игрока
-  def waitMove(self):
+  async def waitMove(self):
     if self.cleanupMode and self.players[self.colours[self.colour]].canCleanup:
-      return self.players[self.colours[self.colour]].sendCommand("kgs-genmove_cleanup %s" % self.colours[self.colour])[0][2:].lower()
+      return (await self.players[self.colours[self.colour]].sendCommand("kgs-genmove_cleanup %s" % self.colours[self.colour]))[0][2:].lower()
     else:
-      return self.players[self.colours[self.colour]].sendCommand("genmove %s" % self.colours[self.colour])[0][2:].lower()
-  # Ждет когда игрок подключится
-  def waitConnect(self):
+      return (await self.players[self.colours[self.colour]].sendCommand("genmove %s" % self.colours[self.colour]))[0][2:].lower()
+  # Ждет когда игрок подключится, но не дольше указанного времени, по истечении времени возвращает "timeout"
+  async def waitConnect(self, time):
     self.playerEvents[self.colours[self.colour]].clear()
-    self.playerBusy.release()
-    try:
-      self.playerEvents[self.colours[self.colour]].wait()
-    finally:
-      self.playerBusy.acquire()
+    if await timeout(self.playerEvents[self.colours[self.colour]].wait(), time) == "timeout":
+      return "timeout"
     self.removeDeadPlayers()
-    if self.colours[self.colour] not in self.players:
-      return None
     return None
   # Удаляет отвалившихся игроков
   def removeDeadPlayers(self):
@@ -754,113 +1660,327 @@ class Game(object):
     for x in self.players:
       if self.players[x].dead:
         del(newPlayers[x])
+        self.record({"t": "leave", "colour": x})
     self.players = newPlayers
   # Начинает игру
-  def startGame(self):
-    self.playerBusy.acquire()
-    self.colour = 0
-    try:
+  async def startGame(self):
+    from time import monotonic
+    if self.state == "finished":
+      return
+    async with self.playerBusy:
+      self.colour = len(self.moves) % 2
       self.removeDeadPlayers()
       for x in self.players:
         for t in range(0,2):
           time, periods = self.timers[t].lastTime()
-          self.players[x].sendCommandWithTimeout("time_left %s %d %d" % (self.colours[t], time, periods))
-      while True:
-        time = self.timers[self.colour].startMove()
-        move = ""
-        while not move:
-          self.removeDeadPlayers()
-          if self.colours[self.colour] not in self.players:
-            print("%s: connection wait %s" % (self.name, self.colours[self.colour]))
-            move = timeout(self.waitConnect, time)
-            if move == "timeout":
-              self.playerEvents[self.colours[self.colour]].set()
-          else:
-            print("%s: move wait %s" % (self.name, self.colours[self.colour]))
-            move = timeout(self.waitMove, time)
-          time = self.timers[self.colour].sameMove()
-        time, periods = self.timers[self.colour].endMove()
+          self.metrics.timeFuture(self.name, "time_left", self.players[x].queueCommand(timeLeftCommand(self.colours[t], time, periods)))
+    while True:
+      time = self.timers[self.colour].startMove()
+      move = ""
+      while not move:
+        self.removeDeadPlayers()
+        if self.colours[self.colour] not in self.players:
+          self.state = "waiting"
+          print("%s: connection wait %s" % (self.name, self.colours[self.colour]))
+          move = await self.waitConnect(time)
+        else:
+          self.state = "thinking"
+          print("%s: move wait %s" % (self.name, self.colours[self.colour]))
+          move = await timeout(self.metrics.timed(self.name, "genmove", self.waitMove()), time)
+        time = self.timers[self.colour].sameMove()
+      async with self.playerBusy:
+        self.state = "applying"
+        rtt = None
+        if move != "timeout" and self.colours[self.colour] in self.players:
+          rtt = self.players[self.colours[self.colour]].rtt
+        time, periods = self.timers[self.colour].endMove(rtt)
+        print("%s: time %s raw %.3f compensated %.3f rtt %s" % (self.name, self.colours[self.colour], self.timers[self.colour].rawTime,
+          self.timers[self.colour].rawTime - self.timers[self.colour].lagCredit, "%.3f" % rtt if rtt is not None else "-"))
         for x in self.players:
-          self.players[x].sendCommandWithTimeout("time_left %s %d %d" % (self.colours[self.colour], time, periods))
+          self.metrics.timeFuture(self.name, "time_left", self.players[x].queueCommand(timeLeftCommand(self.colours[self.colour], time, periods)))
         if move == "resign":
           self.result = "%s+Resign" % self.colours[self.colour ^ 1][0].upper()
-          self.kgsClient.demoTimeLeft(self.kgsGame, self.colours[self.colour], time, periods)
-          self.kgsClient.demoSetResult(self.kgsGame, "%s+RESIGN" % self.colours[self.colour ^ 1][0].upper())
+          if self.broadcast is not None:
+            self.broadcast.timeLeft(self.colours[self.colour], time, periods)
+            self.broadcast.setResult("%s+RESIGN" % self.colours[self.colour ^ 1][0].upper())
           break
         elif self.timers[self.colour].lostOnTime():
           self.result = "%s+Time" % self.colours[self.colour ^ 1][0].upper()
-          self.kgsClient.demoTimeLeft(self.kgsGame, self.colours[self.colour], time, periods)
-          self.kgsClient.demoSetResult(self.kgsGame, "%s+TIME" % self.colours[self.colour ^ 1][0].upper())
+          if self.broadcast is not None:
+            self.broadcast.timeLeft(self.colours[self.colour], time, periods)
+            self.broadcast.setResult("%s+TIME" % self.colours[self.colour ^ 1][0].upper())
           break
-        elif not self.attemptMove(move):
-          self.kgsClient.sendMessage(self.kgsGame, "Attempted move: %s %s" % (self.colours[self.colour], move))
+        elif not await self.attemptMove(move):
           self.result = "%s+Forfeit" % self.colours[self.colour ^ 1][0].upper()
-          self.kgsClient.demoTimeLeft(self.kgsGame, self.colours[self.colour], time, periods)
-          self.kgsClient.demoSetResult(self.kgsGame, "%s+FORFEIT" % self.colours[self.colour ^ 1][0].upper())
+          if self.broadcast is not None:
+            self.broadcast.sendMessage("Attempted move: %s %s" % (self.colours[self.colour], move))
+            self.broadcast.timeLeft(self.colours[self.colour], time, periods)
+            self.broadcast.setResult("%s+FORFEIT" % self.colours[self.colour ^ 1][0].upper())
           break
         else:
-          self.kgsClient.demoPlayMove(self.kgsGame, self.colours[self.colour], move)
-          self.kgsClient.demoTimeLeft(self.kgsGame, self.colours[self.colour], time, periods)
-          if self.referee.gameEnded() and self.finishGame():
-            break
-        print("%s: move %s %s" % (self.name, self.colours[self.colour], move))
-        self.colour ^= 1
-      print("%s: result %s" % (self.name, self.result))
-      self.kgsClient.sendMessage(self.kgsGame, "Game result: %s" % self.result)
-      self.kgsClient.saveGame(self.kgsGame)
-      self.kgsClient.terminate()
-      self.removeDeadPlayers()
-      for x in self.players:
-        self.players[x].session.close()
-      self.referee.sendCommand("quit")
-    finally:
-      self.playerBusy.release()
+          if self.broadcast is not None:
+            self.broadcast.playMove(self.colours[self.colour], move)
+            self.broadcast.timeLeft(self.colours[self.colour], time, periods)
+          if self.sgfRecord is not None:
+            self.sgfRecord.playMove(self.colours[self.colour], move, time, periods, self.timers[self.colour].rawTime)
+          self.metrics.inc("vpgtp_moves_total", self.name)
+          start = monotonic()
+          ended = self.gameEnded()
+          self.metrics.observe(self.name, "game_ended", monotonic() - start)
+          if ended:
+            self.state = "scoring"
+            if await self.finishGame():
+              break
+      print("%s: move %s %s" % (self.name, self.colours[self.colour], move))
+      self.colour ^= 1
+    self.state = "finished"
+    print("%s: result %s" % (self.name, self.result))
+    self.removeDeadPlayers()
+    self.record({"t": "result", "result": self.result, "timers": [x.state() for x in self.timers]})
+    if self.journal is not None:
+      self.journal.close(self.name)
+    if self.sgfRecord is not None:
+      self.sgfRecord.close(self.result)
+    if self.broadcast is not None:
+      self.broadcast.sendMessage("Game result: %s" % self.result)
+      self.broadcast.saveGame()
+      await self.broadcast.close()
+      await self.kgsHub.release(self.kgsClient)
+    for x in self.players:
+      self.players[x].quit()
+    await self.referee.quit()
+  # Прерывает партию после ошибки: партия считается законченной без результата, игроки и судья отключаются
+  # Результат в журнал не записывается, поэтому после перезапуска сервера партия продолжится
+  async def abort(self, error):
+    self.result = "Void (%s)" % error
+    self.state = "finished"
+    if self.journal is not None:
+      self.journal.close(self.name)
+    if self.sgfRecord is not None:
+      self.sgfRecord.close("Void")
+    for x in self.players:
+      self.players[x].quit()
+    try:
+      if self.broadcast is not None:
+        self.broadcast.sendMessage("Game aborted: %s" % error)
+        await self.broadcast.close()
+        await self.kgsHub.release(self.kgsClient)
+    except Exception:
+      pass
+    if self.referee.proc is not None and self.referee.proc.returncode is None:
+      self.referee.proc.kill()
+  # Перепроверяет результат партии программой GTP, возвращает None, если проверка невозможна
+  async def checkResult(self):
+    referee = Referee(self.refereeCheck, self.refereeSetup)
+    try:
+      await referee.start()
+      for colour, move in self.moves:
+        if (await referee.sendCommand("play %s %s" % (colour, move)))[0][:2] != "= ":
+          await referee.quit()
+          return "illegal move %s %s" % (colour, move)
+      result = (await referee.sendCommand("final_score"))[0][2:].upper()
+      await referee.quit()
+      return result
+    except Exception:
+      if referee.proc:
+        referee.proc.kill()
+      return None
   # Производит подсчет
-  def finishGame(self):
+  async def finishGame(self):
     self.removeDeadPlayers()
     if len(self.players) == 2:
       deadStones = []
       for x in self.players:
-        deadStones.append(set(stone.lower() for stone in " ".join(self.players[x].sendCommandWithTimeout("final_status_list dead"))[2:].split()))
+        deadStones.append(set(stone.lower() for stone in " ".join(await self.players[x].sendCommandWithTimeout("final_status_list dead"))[2:].split()))
       if deadStones[0] != deadStones[1]:
         self.cleanupMode = True
-        self.kgsClient.sendMessage(self.kgsGame, "Players do not agree on dead stones status")
+        self.record({"t": "cleanup"})
+        if self.broadcast is not None:
+          self.broadcast.sendMessage("Players do not agree on dead stones status")
         return False
+      self.referee.setDeadStones(deadStones[0])
     results = []
     self.removeDeadPlayers()
     for x in self.players:
-      results.append(self.players[x].sendCommandWithTimeout("final_score")[0][2:].upper())
-    results.append(self.referee.sendCommand("final_score")[0][2:].upper())
+      results.append((await self.players[x].sendCommandWithTimeout("final_score"))[0][2:].upper())
+    results.append((await self.referee.sendCommand("final_score"))[0][2:].upper())
+    if self.refereeCheck:
+      checkResult = await self.checkResult()
+      print("%s: referee check %s" % (self.name, checkResult))
+      if checkResult != results[-1] and self.broadcast is not None:
+        self.broadcast.sendMessage("Referee check: %s" % checkResult)
     if results[1:] == results[:-1]:
       self.result = results[0]
-      self.kgsClient.demoSetResult(self.kgsGame, self.result)
+      if self.broadcast is not None:
+        self.broadcast.setResult(self.result)
     elif results[1:-1] == results[:-2]:
       self.result = "players: %s, referee: %s" % (results[0], results[-1])
     else:
       self.result = "players do not agree, referee: %s" % results[-1]
     return True
 
+# Гистограмма длительностей
+class Histogram(object):
+  __slots__ = ("counts", "sum", "count")
+  def __init__(self, buckets):
+    self.counts = [0] * len(buckets)
+    self.sum = 0.0
+    self.count = 0
+
+# Метрики сервера: гистограммы длительностей этапов хода, счетчики и задержки соединений в текстовом формате Prometheus
+class Metrics(object):
+  buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+  def __init__(self):
+    self.phases = {}
+    self.counters = {}
+  # Учитывает длительность этапа партии (в секундах)
+  def observe(self, game, phase, seconds):
+    from bisect import bisect_left
+    key = (game, phase)
+    histogram = self.phases.get(key)
+    if histogram is None:
+      histogram = self.phases[key] = Histogram(self.buckets)
+    i = bisect_left(self.buckets, seconds)
+    if i < len(self.buckets):
+      histogram.counts[i] += 1
+    histogram.sum += seconds
+    histogram.count += 1
+  # Увеличивает счетчик партии
+  def inc(self, name, game, value = 1):
+    key = (name, game)
+    self.counters[key] = self.counters.get(key, 0) + value
+  # Выполняет сопрограмму и учитывает ее длительность как этап партии
+  async def timed(self, game, phase, coro):
+    from time import monotonic
+    start = monotonic()
+    try:
+      return await coro
+    finally:
+      self.observe(game, phase, monotonic() - start)
+  # Учитывает время до ответа на команду, поставленную в очередь
+  def timeFuture(self, game, phase, future):
+    from time import monotonic
+    start = monotonic()
+    def done(x):
+      if not x.cancelled() and x.result() is not None:
+        self.observe(game, phase, monotonic() - start)
+    future.add_done_callback(done)
+    return future
+  # Возвращает значение метки в формате Prometheus
+  @staticmethod
+  def label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+  # Возвращает метрики в текстовом формате Prometheus, задержки соединений берутся из текущего состояния партий
+  def render(self, games):
+    lines = ["# HELP vpgtp_phase_seconds Duration of move phases", "# TYPE vpgtp_phase_seconds histogram"]
+    for (game, phase), histogram in sorted(self.phases.items()):
+      labels = 'game="%s",phase="%s"' % (self.label(game), phase)
+      total = 0
+      for i in range(0, len(self.buckets)):
+        total += histogram.counts[i]
+        lines.append('vpgtp_phase_seconds_bucket{%s,le="%g"} %d' % (labels, self.buckets[i], total))
+      lines.append('vpgtp_phase_seconds_bucket{%s,le="+Inf"} %d' % (labels, histogram.count))
+      lines.append("vpgtp_phase_seconds_sum{%s} %f" % (labels, histogram.sum))
+      lines.append("vpgtp_phase_seconds_count{%s} %d" % (labels, histogram.count))
+    names = sorted(set(name for name, game in self.counters))
+    for name in names:
+      lines.append("# TYPE %s counter" % name)
+      for (counter, game), value in sorted(self.counters.items()):
+        if counter == name:
+          lines.append('%s{game="%s"} %d' % (name, self.label(game), value))
+    lines.append("# HELP vpgtp_player_rtt_seconds Last round trip time of a player command without thinking")
+    lines.append("# TYPE vpgtp_player_rtt_seconds gauge")
+    for game in games:
+      for colour in sorted(game.players):
+        player = game.players[colour]
+        if player.rtt is not None:
+          lines.append('vpgtp_player_rtt_seconds{game="%s",colour="%s",player="%s"} %f' % (self.label(game.name), colour, self.label(player.name), player.rtt))
+    lines.append("# HELP vpgtp_kgs_rtt_seconds Last time for KGS to confirm a move")
+    lines.append("# TYPE vpgtp_kgs_rtt_seconds gauge")
+    for game in games:
+      if game.broadcast is not None and game.broadcast.rtt is not None:
+        lines.append('vpgtp_kgs_rtt_seconds{game="%s"} %f' % (self.label(game.name), game.broadcast.rtt))
+    lines.append("# HELP vpgtp_game_state Current state of the game (1 for the current state)")
+    lines.append("# TYPE vpgtp_game_state gauge")
+    for game in games:
+      for state in Game.states:
+        lines.append('vpgtp_game_state{game="%s",state="%s"} %d' % (self.label(game.name), state, game.state == state))
+    lines.append("# TYPE vpgtp_game_moves gauge")
+    for game in games:
+      lines.append('vpgtp_game_moves{game="%s"} %d' % (self.label(game.name), len(game.moves)))
+    return "\n".join(lines) + "\n"
+
+# Поток записи одного канала соединения, по которому vpgtpc передает данные нескольких программ
+# Данные каждого канала передаются кадрами "vpgtp-frame <канал> <длина>\n<данные>", кадр нулевой длины закрывает канал
+class MuxWriter(object):
+  # Принимает поток записи соединения, номер канала и функцию, вызываемую при закрытии канала
+  def __init__(self, writer, channel, onClose):
+    self.writer = writer
+    self.channel = channel
+    self.onClose = onClose
+    self.closed = False
+  # Отправляет данные кадром канала
+  def write(self, data):
+    if data and not self.closed and not self.writer.is_closing():
+      self.writer.write(b"vpgtp-frame %d %d\n" % (self.channel, len(data)) + data)
+  # Закрывает канал
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      if not self.writer.is_closing():
+        self.writer.write(b"vpgtp-frame %d 0\n" % self.channel)
+      self.onClose(self.channel)
+  # Возвращает сведения о соединении
+  def get_extra_info(self, name, default = None):
+    return self.writer.get_extra_info(name, default)
+
 # Класс для управления сервером
 class Server(object):
-  # Принимает адрес, порт, командную строку судьи, команды настройки судьи, команды настройки игроков, ники и пароли KGS, участников и настройки времени
-  def __init__(self, host, port, referee, refereeSetup, playerSetup, kgsApi, kgsRooms, kgsNames, kgsPwds, kgsTitles, participants, participantIds, mainTime, byoyomiTime, byoyomiMoves):
+  # Принимает адрес, порт, командную строку судьи (None для встроенного судьи), команды настройки судьи, команды настройки игроков, ники и пароли KGS, участников, настройки времени, максимальный размер ответа игрока, командную строку судьи для перепроверки результата, число демонстраций на один аккаунт KGS, порт метрик (None, чтобы не публиковать метрики), возвращаемую игрокам долю задержки сети, предел возврата в секундах, размеры досок и коми партий, канал к основному процессу (None, если сервер сам принимает соединения),
+  # функцию для передачи сообщений о состоянии партий координатору, журнал партий, каталог для записей SGF и адрес, на котором публикуются метрики
+  # Без адреса API KGS (None) партии не транслируются на KGS
+  def __init__(self, host, port, referee, refereeSetup, playerSetup, kgsApi, kgsRooms, kgsNames, kgsPwds, kgsTitles, participants, participantIds, mainTime, byoyomiTime, byoyomiMoves, maxResponseSize = 1048576, refereeCheck = None, kgsDemosPerAccount = 1, metricsPort = None, lagShare = 0, lagCap = 0, boardSizes = None, komis = None, shardSock = None, reporter = None, journal = None, sgfDir = None, metricsHost = "127.0.0.1"):
     self.host = host
     self.port = port
+    self.shardSock = shardSock
+    self.reporter = reporter
+    self.metricsPort = metricsPort
+    self.metricsHost = metricsHost
+    self.metrics = Metrics()
+    self.metricsRunner = None
+    self.maxResponseSize = maxResponseSize
     self.playerSetup = playerSetup
     self.participants = participants
     self.participantIds = participantIds
+    self.capabilities = {}
     numGames = len(participants)
     self.games = []
     self.sock = None
-    self.threads = []
+    self.kgsHub = KgsHub(kgsApi, kgsDemosPerAccount) if kgsApi else None
+    if boardSizes is None:
+      boardSizes = [19] * numGames
+    if komis is None:
+      komis = [7.5] * numGames
     for i in range(0, numGames):
-      self.games.append(Game(referee, refereeSetup, kgsApi, kgsRooms[i], kgsNames[i], kgsPwds[i], kgsTitles[i], participants[i], participantIds[i], mainTime, byoyomiTime, byoyomiMoves))
+      self.games.append(Game(referee, refereeSetup, self.kgsHub, kgsRooms[i], kgsNames[i], kgsPwds[i], kgsTitles[i], participants[i], participantIds[i], mainTime, byoyomiTime, byoyomiMoves, refereeCheck, self.metrics, lagShare, lagCap, boardSizes[i], komis[i], journal, sgfDir))
+  # Подготавливает игры
+  async def setupGames(self):
+    from asyncio import gather
+    await gather(*[x.setup() for x in self.games])
   # Настраивает игрока
-  def setupParticipant(self, socket):
+  # Соединение, которое начинается строкой vpgtp-mux, передает данные нескольких игроков
+  async def setupParticipant(self, reader, writer, received = b""):
+    print("Client was accepted: %s" % writer.get_extra_info("peername")[0])
+    if not received:
+      received = await timeout(reader.readline(), 30, b"") or b""
+    if received.split(b"\n", 1)[0].strip() == b"vpgtp-mux":
+      await self.demultiplex(reader, writer, received.split(b"\n", 1)[1])
+      return
+    player = Player(reader, writer, self.maxResponseSize)
     try:
-      player = Player(socket)
-    except:
-      socket.close()
+      await player.handshake(received, self.capabilities)
+    except Exception:
+      player.close()
       return
     game = None
     for i in range(0, len(self.participantIds)):
@@ -870,109 +1990,508 @@ class Server(object):
           break
       if game is not None:
         break
-    if game is None or self.games[game].result:
-      socket.close()
+    if game is None:
+      player.close()
+      return
+    if self.games[game].state == "finished":
+      player.quit()
       return
     colour = self.games[game].playerColours[player.id]
-    self.games[game].playerBusy.acquire()
-    try:
-      self.games[game].removeDeadPlayers()
-      if colour not in self.games[game].players:
-        print("Player joined: %s as %s in %s" % (player.name, colour, self.games[game].name))
-        self.games[game].kgsClient.sendMessage(self.games[game].kgsGame, "Joined: %s" % (player.name))
-        self.games[game].players[colour] = player
-        for x in self.playerSetup:
-           self.games[game].players[colour].sendCommandWithTimeout(x)
-        self.games[game].referee.preparePlayer(self.games[game].players[colour])
-        playColour = self.games[game].colour
-        if playColour is not None:
-          time, periods = self.games[game].timers[playColour].currentTime()
-          self.games[game].players[colour].sendCommandWithTimeout("time_left %s %d %d" % (self.games[game].colours[playColour], time, periods))
-          time, periods = self.games[game].timers[playColour ^ 1].lastTime()
-          self.games[game].players[colour].sendCommandWithTimeout("time_left %s %d %d" % (self.games[game].colours[playColour ^ 1], time, periods))
-        self.games[game].playerEvents[colour].set()
+    if not await self.games[game].join(player, self.playerSetup):
+      if self.games[game].state == "finished":
+        player.quit()
       else:
-        socket.close()
-    finally:
-      self.games[game].playerBusy.release()
-  # Запускает сервер
-  def startServer(self):
-    import socket
+        player.close()
+      return
+    print("Player joined: %s as %s in %s" % (player.name, colour, self.games[game].name))
+    self.report({"type": "joined", "game": self.games[game].name, "colour": colour, "player": player.name})
+    if self.games[game].broadcast is not None:
+      self.games[game].broadcast.sendMessage("Joined: %s" % (player.name))
+  # Разбирает кадры соединения с несколькими игроками и подключает игрока каждого нового канала
+  async def demultiplex(self, reader, writer, data):
+    from asyncio import StreamReader
+    channels = {}
+    def closeChannel(channel):
+      if channel in channels:
+        channels.pop(channel).feed_eof()
     try:
-      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.sock.bind((self.host, self.port))
-      self.sock.listen(1)
-      print("Server started")
       while True:
-        conn, (cl_addr, cl_port) = self.sock.accept()
-        print("Client was accepted: %s" % cl_addr)
-        threadStart(lambda: self.setupParticipant(conn))
-    except:
+        while b"\n" not in data:
+          chunk = await reader.read(65536)
+          if not chunk:
+            return
+          data += chunk
+        header, data = data.split(b"\n", 1)
+        words = header.split()
+        if len(words) != 3 or words[0] != b"vpgtp-frame":
+          return
+        channel, length = int(words[1]), int(words[2])
+        while len(data) < length:
+          chunk = await reader.read(65536)
+          if not chunk:
+            return
+          data += chunk
+        payload, data = data[:length], data[length:]
+        if length == 0:
+          closeChannel(channel)
+        elif channel in channels:
+          channels[channel].feed_data(payload)
+        else:
+          channels[channel] = StreamReader()
+          channels[channel].feed_data(payload)
+          taskStart(self.setupParticipant(channels[channel], MuxWriter(writer, channel, closeChannel)))
+    except (ConnectionError, ValueError):
       pass
-  def stopServer(self):
+    finally:
+      for x in list(channels):
+        closeChannel(x)
+      writer.close()
+  # Запускает сервер
+  async def startServer(self):
+    from asyncio import start_server, get_event_loop
+    if self.shardSock is None:
+      self.sock = await start_server(self.setupParticipant, self.host, self.port)
+    else:
+      self.shardSock.setblocking(False)
+      get_event_loop().add_reader(self.shardSock.fileno(), self.receiveShard)
+    print("Server started")
+    if self.metricsPort:
+      await self.startMetrics()
+  # Запускает публикацию метрик по HTTP
+  async def startMetrics(self):
+    from aiohttp import web
+    async def handle(request):
+      return web.Response(text = self.metrics.render(self.games), content_type = "text/plain", charset = "utf-8")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    self.metricsRunner = web.AppRunner(app)
+    await self.metricsRunner.setup()
+    await web.TCPSite(self.metricsRunner, self.metricsHost, self.metricsPort).start()
+    print("Metrics are available on %s:%d" % (self.metricsHost, self.metricsPort))
+  # Останавливает сервер
+  async def stopServer(self):
+    from asyncio import get_event_loop
+    if self.shardSock is not None:
+      get_event_loop().remove_reader(self.shardSock.fileno())
     if self.sock:
       self.sock.close()
+      await self.sock.wait_closed()
       print("Server has stopped")
+    if self.metricsRunner:
+      await self.metricsRunner.cleanup()
+  # Принимает соединения игроков, переданные основным процессом
+  def receiveShard(self):
+    from json import loads
+    import socket
+    while True:
+      try:
+        msg, fds, flags, addr = socket.recv_fds(self.shardSock, 65536, 1)
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError:
+        msg, fds = b"", []
+      if not msg:
+        from asyncio import get_event_loop
+        get_event_loop().remove_reader(self.shardSock.fileno())
+        return
+      if fds:
+        taskStart(self.acceptShard(socket.socket(fileno = fds[0]), loads(msg.decode("utf-8"))))
+  # Подключает игрока по соединению, переданному основным процессом
+  async def acceptShard(self, conn, info):
+    from asyncio import open_connection
+    reader, writer = await open_connection(sock = conn)
+    await self.setupParticipant(reader, writer, info["data"].encode("latin-1"))
+  # Сообщает основному процессу о состоянии партий
+  def report(self, msg):
+    from json import dumps
+    if self.reporter is not None:
+      self.reporter(msg)
+    if self.shardSock is None:
+      return
+    try:
+      self.shardSock.send(dumps(msg).encode("utf-8"))
+    except OSError:
+      pass
+  # Проводит игру и сообщает ее результат
+  # Ошибка в одной партии прерывает только эту партию
+  async def playGame(self, game):
+    from traceback import print_exc
+    try:
+      await game.startGame()
+    except Exception as e:
+      print("%s: game aborted" % game.name)
+      print_exc()
+      await game.abort(repr(e))
+    self.report({"type": "result", "game": game.name, "result": game.result, "moves": len(game.moves)})
   # Запускает игры
-  def startGames(self):
-    for x in self.games:
-      self.threads.append(threadStart(x.startGame))
-    for x in self.threads:
-      x.join()
+  async def startGames(self):
+    from asyncio import gather
+    await gather(*[self.playGame(x) for x in self.games])
+  # Проводит раунд: готовит игры, принимает игроков и начинает игры в указанное время
+  async def run(self, roundStart):
+    from asyncio import sleep
+    from datetime import datetime
+    await self.setupGames()
+    await self.startServer()
+    diff = (roundStart - datetime.now()).total_seconds()
+    if diff > 0:
+      print("Waiting for games to start")
+      await sleep(diff)
+    print("Starting games")
+    await self.startGames()
+    await self.stopServer()
+    if self.kgsHub is not None:
+      await self.kgsHub.close()
 
-if __name__ == '__main__':
-  from configparser import ConfigParser
-  from time import sleep
+# Читает настройки сервера и партий
+def loadConfig(config):
   from datetime import datetime
-  import sys
-  config = ConfigParser()
-  config.read(sys.argv[1])
-  host = config["Server"]["Host"]
-  port = int(config["Server"]["Port"])
-  referee = config["Server"]["RefereeCmd"]
-  kgsApi = config["Server"]["KgsApi"]
-  refereeSetup = list(config["RefereeSetupCommands"].values())
-  playerSetup = list(config["PlayerSetupCommands"].values())
+  settings = {}
+  server = config["Server"]
+  settings["host"] = server["Host"]
+  settings["port"] = int(server["Port"])
+  settings["referee"] = server.get("RefereeCmd")
+  settings["refereeCheck"] = None
+  if server.get("Referee", "gtp") == "builtin":
+    if server.getboolean("RefereeCheck", False):
+      settings["refereeCheck"] = settings["referee"]
+    settings["referee"] = None
+  settings["kgsApi"] = server.get("KgsApi")
+  settings["refereeSetup"] = list(config["RefereeSetupCommands"].values())
+  settings["playerSetup"] = list(config["PlayerSetupCommands"].values())
+  settings["mainTime"] = float(server["MainTime"])
+  settings["byoyomiTime"] = float(server["ByoyomiTime"])
+  settings["byoyomiMoves"] = int(server["ByoyomiMoves"])
+  settings["maxResponseSize"] = int(server.get("MaxResponseSize", "1048576"))
+  settings["kgsDemosPerAccount"] = int(server.get("KgsDemosPerAccount", "1"))
+  settings["metricsPort"] = server.getint("MetricsPort")
+  settings["metricsHost"] = server.get("MetricsHost", "127.0.0.1")
+  settings["lagShare"] = server.getfloat("LagShare", 0)
+  settings["lagCap"] = server.getfloat("LagCap", 0)
+  settings["workers"] = server.getint("Workers", 1)
+  settings["journalDir"] = server.get("JournalDir")
+  settings["sgfDir"] = server.get("SgfDir")
+  settings["roundStart"] = datetime.strptime(server["RoundStart"], "%d.%m.%Y %H:%M")
+  # Дробное время округляется вниз, но не до 0, который в time_settings означает отсутствие ограничения
+  settings["playerSetup"].append("time_settings %d %d %d" % (wholeSeconds(settings["mainTime"]), wholeSeconds(settings["byoyomiTime"]), settings["byoyomiMoves"]))
+  boardSize = 19
+  komi = 7.5
+  for x in settings["refereeSetup"]:
+    args = x.split()
+    if len(args) == 2 and args[0].lower() == "boardsize":
+      boardSize = int(args[1])
+    elif len(args) == 2 and args[0].lower() == "komi":
+      komi = float(args[1])
+  boardSize = server.getint("BoardSize", boardSize)
+  komi = server.getfloat("Komi", komi)
+  games = []
   gameIds = []
-  kgsRooms = []
-  kgsNames = []
-  kgsPwds = []
-  participants = []
-  participantIds = []
-  mainTime = int(config["Server"]["MainTime"])
-  byoyomiTime = int(config["Server"]["ByoyomiTime"])
-  byoyomiMoves = int(config["Server"]["ByoyomiMoves"])
-  playerSetup.append("time_settings %d %d %d" % (mainTime, byoyomiTime, byoyomiMoves))
-  roundStart = datetime.strptime(config["Server"]["RoundStart"], "%d.%m.%Y %H:%M")
   for x in config.sections():
     v = x.split("=")
     if v[0] != "Game" or len(v) != 2:
       continue
-    kgsRoom = config[x]["KGSRoom"]
-    kgsName = config[x]["KGSName"]
-    kgsPwd = config[x]["KGSPassword"]
-    botNames = [config[x]["Player1"], config[x]["Player2"]]
-    botIds = [config[x]["Player1ID"], config[x]["Player2ID"]]
+    game = {
+      "id": v[1],
+      "kgsRoom": config[x].get("KGSRoom"),
+      "kgsName": config[x].get("KGSName"),
+      "kgsPwd": config[x].get("KGSPassword"),
+      "names": [config[x]["Player1"], config[x]["Player2"]],
+      "ids": [config[x]["Player1ID"], config[x]["Player2ID"]],
+      "boardSize": config[x].getint("BoardSize", boardSize),
+      "komi": config[x].getfloat("Komi", komi),
+      "node": config[x].get("Node")
+    }
     if v[1] in gameIds:
-      ind = gameIds.index(v[1])
-      kgsRooms[ind] = kgsRoom
-      kgsNames[ind] = kgsName
-      kgsPwds[ind] = kgsPwd
-      participants[ind] = botNames
-      participantIds[ind] = botIds
+      games[gameIds.index(v[1])] = game
     else:
       gameIds.append(v[1])
-      kgsRooms.append(kgsRoom)
-      kgsNames.append(kgsName)
-      kgsPwds.append(kgsPwd)
-      participants.append(botNames)
-      participantIds.append(botIds)
-  server = Server(host, port, referee, refereeSetup, playerSetup, kgsApi, kgsRooms, kgsNames, kgsPwds, gameIds, participants, participantIds, mainTime, byoyomiTime, byoyomiMoves)
-  threadStart(server.startServer)
-  diff = (roundStart - datetime.now()).total_seconds()
-  if diff > 0:
-    print("Waiting for games to start")
-    sleep(diff)
-  print("Starting games")
-  server.startGames()
-  server.stopServer()
+      games.append(game)
+  settings["games"] = games
+  return settings
+
+# Создает сервер для указанных партий (None для всех), адрес, порт и порт метрик по умолчанию берутся из настроек
+# Порт метрик 0 отключает метрики
+def createServer(settings, gameIds = None, host = None, port = None, metricsPort = None, shardSock = None, reporter = None):
+  games = [x for x in settings["games"] if gameIds is None or x["id"] in gameIds]
+  journal = None
+  if settings["journalDir"]:
+    journal = Journal(settings["journalDir"], settings["roundStart"].strftime("%Y-%m-%d %H:%M"))
+  return Server(host or settings["host"], port or settings["port"], settings["referee"], settings["refereeSetup"], settings["playerSetup"], settings["kgsApi"],
+    [x["kgsRoom"] for x in games], [x["kgsName"] for x in games], [x["kgsPwd"] for x in games], [x["id"] for x in games],
+    [x["names"] for x in games], [x["ids"] for x in games], settings["mainTime"], settings["byoyomiTime"], settings["byoyomiMoves"],
+    settings["maxResponseSize"], settings["refereeCheck"], settings["kgsDemosPerAccount"], settings["metricsPort"] if metricsPort is None else metricsPort,
+    settings["lagShare"], settings["lagCap"], [x["boardSize"] for x in games], [x["komi"] for x in games], shardSock, reporter, journal, settings["sgfDir"], settings["metricsHost"])
+
+# Координатор турнира на нескольких узлах: распределяет партии между узлами vpgtpd, перенаправляет игроков
+# на узел их партии строкой "vpgtp-redirect <адрес> <порт>" и собирает состояние и результаты партий
+class Coordinator(object):
+  # Принимает адрес и порт для игроков, адрес и порт для узлов, текст настроек, партии и имена ожидаемых узлов
+  def __init__(self, host, port, controlHost, controlPort, configText, games, nodeNames):
+    from asyncio import Event
+    self.host = host
+    self.port = port
+    self.controlHost = controlHost
+    self.controlPort = controlPort
+    self.configText = configText
+    self.games = games
+    self.nodeNames = nodeNames
+    self.nodes = {}
+    self.finished = set()
+    self.owners = {}
+    self.status = {}
+    self.connected = Event()
+    self.assigned = Event()
+    self.done = Event()
+  # Принимает подключение узла и его сообщения о состоянии партий
+  async def handleNode(self, reader, writer):
+    from json import loads
+    name = None
+    try:
+      hello = loads((await reader.readline()).decode("utf-8"))
+      name = hello["name"]
+      if name not in self.nodeNames or name in self.nodes:
+        writer.close()
+        return
+      self.nodes[name] = {"host": hello["host"], "port": hello["port"], "writer": writer, "games": []}
+      print("Node connected: %s (%s:%d)" % (name, hello["host"], hello["port"]))
+      if len(self.nodes) == len(self.nodeNames):
+        self.connected.set()
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        self.nodeReport(name, loads(line.decode("utf-8")))
+    except (ValueError, KeyError, ConnectionError):
+      pass
+    finally:
+      writer.close()
+      if name in self.nodes:
+        print("Node disconnected: %s" % name)
+        self.finished.add(name)
+        if self.assigned.is_set() and len(self.finished) == len(self.nodes):
+          self.done.set()
+  # Учитывает сообщение узла о состоянии партий
+  def nodeReport(self, node, msg):
+    if msg["type"] == "joined":
+      print("Node %s: %s joined %s as %s" % (node, msg["player"], msg["game"], msg["colour"]))
+    elif msg["type"] == "result":
+      self.status[msg["game"]] = msg
+      print("Node %s: %s result %s after %d moves" % (node, msg["game"], msg["result"], msg["moves"]))
+  # Распределяет партии: закрепленные за узлом партии отдаются ему, остальные - наименее загруженному узлу
+  def assign(self):
+    from json import dumps
+    for game in self.games:
+      node = game["node"]
+      if node not in self.nodes:
+        node = min(self.nodes, key = lambda x: len(self.nodes[x]["games"]))
+      self.nodes[node]["games"].append(game["id"])
+      for x in game["ids"]:
+        self.owners[x] = node
+    for name in self.nodes:
+      print("Node %s: %s" % (name, ", ".join(self.nodes[name]["games"])))
+      msg = {"type": "assign", "config": self.configText, "games": self.nodes[name]["games"]}
+      self.nodes[name]["writer"].write((dumps(msg) + "\n").encode("utf-8"))
+    self.assigned.set()
+  # Перенаправляет игрока на узел его партии
+  async def handlePlayer(self, reader, writer):
+    try:
+      line = await timeout(reader.readline(), 30, b"")
+      id = ((line or b"").decode("utf-8", "replace").split() or [""])[0]
+      await self.assigned.wait()
+      node = self.owners.get(id)
+      if node is not None:
+        print("Player %s redirected to %s" % (id, node))
+        writer.write(("vpgtp-redirect %s %d\n" % (self.nodes[node]["host"], self.nodes[node]["port"])).encode("utf-8"))
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+  # Проводит раунд: ждет узлы, распределяет партии, перенаправляет игроков и выводит результаты
+  async def run(self):
+    from asyncio import start_server
+    control = await start_server(self.handleNode, self.controlHost, self.controlPort)
+    players = await start_server(self.handlePlayer, self.host, self.port)
+    print("Coordinator started, waiting for nodes: %s" % ", ".join(self.nodeNames))
+    await self.connected.wait()
+    self.assign()
+    await self.done.wait()
+    players.close()
+    control.close()
+    print("Coordinator has stopped")
+    for x in self.games:
+      if x["id"] in self.status:
+        print("%s: %s" % (x["id"], self.status[x["id"]]["result"]))
+      else:
+        print("%s: no result" % x["id"])
+
+# Узел турнира: получает партии от координатора, проводит их и сообщает о состоянии партий
+class ClusterNode(object):
+  # Принимает имя узла, адрес и порт координатора, адрес и порт для игроков, адрес для игроков, сообщаемый координатором, и порт метрик
+  def __init__(self, name, coordinatorHost, coordinatorPort, host, port, publicHost, metricsPort = None):
+    self.name = name
+    self.coordinatorHost = coordinatorHost
+    self.coordinatorPort = coordinatorPort
+    self.host = host
+    self.port = port
+    self.publicHost = publicHost
+    self.metricsPort = metricsPort
+    self.writer = None
+  # Передает сообщение о состоянии партий координатору
+  def report(self, msg):
+    from json import dumps
+    if not self.writer.is_closing():
+      self.writer.write((dumps(msg) + "\n").encode("utf-8"))
+  # Подключается к координатору, повторяя попытки, получает партии и проводит их
+  async def run(self):
+    from asyncio import open_connection, sleep
+    from configparser import ConfigParser
+    from json import dumps, loads
+    while True:
+      try:
+        reader, self.writer = await open_connection(self.coordinatorHost, self.coordinatorPort)
+        break
+      except OSError:
+        await sleep(1)
+    self.writer.write((dumps({"type": "hello", "name": self.name, "host": self.publicHost, "port": self.port}) + "\n").encode("utf-8"))
+    line = await reader.readline()
+    if not line:
+      print("Coordinator has closed the connection")
+      return
+    msg = loads(line.decode("utf-8"))
+    config = ConfigParser()
+    config.read_string(msg["config"])
+    settings = loadConfig(config)
+    print("Games: %s" % ", ".join(msg["games"]))
+    # Порт метрик координатора узлу не передается: узлы на одной машине не должны занимать один порт
+    server = createServer(settings, msg["games"], self.host, self.port, self.metricsPort or 0, reporter = self.report)
+    await server.run(settings["roundStart"])
+    await self.writer.drain()
+    self.writer.close()
+
+# Основной процесс для игры в нескольких процессах: принимает соединения, по идентификатору игрока передает соединение
+# процессу, который ведет его партию, и собирает состояние партий
+class ShardServer(object):
+  # Принимает адрес, порт, файл настроек, число процессов, названия партий и идентификаторы их участников
+  def __init__(self, host, port, configPath, workers, gameNames, participantIds):
+    self.host = host
+    self.port = port
+    self.configPath = configPath
+    self.workers = workers
+    self.gameNames = gameNames
+    self.owners = {}
+    for i in range(0, len(participantIds)):
+      for x in participantIds[i]:
+        self.owners[x] = i % workers
+    self.socks = []
+    self.procs = []
+    self.status = {}
+  # Запускает процессы, которые ведут партии
+  async def startWorkers(self):
+    from asyncio import create_subprocess_exec, get_event_loop
+    import os
+    import socket
+    import sys
+    for i in range(0, self.workers):
+      parentSock, childSock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+      proc = await create_subprocess_exec(sys.executable, os.path.abspath(__file__), self.configPath, "--worker", str(i), str(childSock.fileno()), pass_fds = [childSock.fileno()])
+      childSock.close()
+      self.socks.append(parentSock)
+      self.procs.append(proc)
+      get_event_loop().add_reader(parentSock.fileno(), self.receiveReport, i)
+      print("Worker %d started: %d" % (i, proc.pid))
+  # Принимает сообщение о состоянии партий от процесса
+  def receiveReport(self, worker):
+    from asyncio import get_event_loop
+    from json import loads
+    try:
+      msg = self.socks[worker].recv(65536)
+    except OSError:
+      msg = b""
+    if not msg:
+      get_event_loop().remove_reader(self.socks[worker].fileno())
+      return
+    msg = loads(msg.decode("utf-8"))
+    if msg["type"] == "joined":
+      print("Worker %d: %s joined %s as %s" % (worker, msg["player"], msg["game"], msg["colour"]))
+    elif msg["type"] == "result":
+      self.status[msg["game"]] = msg
+      print("Worker %d: %s result %s after %d moves" % (worker, msg["game"], msg["result"], msg["moves"]))
+  # Читает строку идентификатора и передает соединение процессу, который ведет партию игрока
+  async def route(self, conn):
+    from asyncio import get_event_loop, wait_for
+    from json import dumps
+    import socket
+    loop = get_event_loop()
+    data = b""
+    try:
+      while b"\n" not in data and len(data) < 4096:
+        chunk = await wait_for(loop.sock_recv(conn, 4096), 30)
+        if not chunk:
+          break
+        data += chunk
+      if b"\n" in data:
+        id = (data.split(b"\n", 1)[0].decode("utf-8", "replace").split() or [""])[0]
+        worker = self.owners.get(id)
+        if worker is not None and self.procs[worker].returncode is None:
+          socket.send_fds(self.socks[worker], [dumps({"data": data.decode("latin-1")}).encode("utf-8")], [conn.fileno()])
+    except Exception:
+      pass
+    finally:
+      conn.close()
+  # Принимает соединения
+  async def accept(self, sock):
+    from asyncio import get_event_loop
+    loop = get_event_loop()
+    while True:
+      conn, addr = await loop.sock_accept(sock)
+      print("Client was accepted: %s" % addr[0])
+      taskStart(self.route(conn))
+  # Проводит раунд в нескольких процессах и выводит результаты партий
+  async def run(self):
+    from asyncio import gather
+    import socket
+    await self.startWorkers()
+    sock = socket.create_server((self.host, self.port))
+    sock.setblocking(False)
+    acceptor = taskStart(self.accept(sock))
+    print("Server started")
+    await gather(*[x.wait() for x in self.procs])
+    acceptor.cancel()
+    sock.close()
+    print("Server has stopped")
+    for x in self.gameNames:
+      if x in self.status:
+        print("%s: %s" % (x, self.status[x]["result"]))
+      else:
+        print("%s: no result" % x)
+
+if __name__ == '__main__':
+  from configparser import ConfigParser
+  from asyncio import run
+  import sys
+  config = ConfigParser()
+  config.read(sys.argv[1])
+  if config.has_section("Node"):
+    node = config["Node"]
+    coordinatorHost, coordinatorPort = node["Coordinator"].rsplit(":", 1)
+    run(ClusterNode(node["Name"], coordinatorHost, int(coordinatorPort), node["Host"], int(node["Port"]), node.get("PublicHost", node["Host"]), node.getint("MetricsPort")).run())
+    sys.exit(0)
+  settings = loadConfig(config)
+  if len(sys.argv) > 4 and sys.argv[2] == "--worker":
+    import socket
+    index = int(sys.argv[3])
+    gameIds = [settings["games"][i]["id"] for i in range(0, len(settings["games"])) if i % settings["workers"] == index]
+    metricsPort = settings["metricsPort"] + index + 1 if settings["metricsPort"] else None
+    server = createServer(settings, gameIds, metricsPort = metricsPort, shardSock = socket.socket(fileno = int(sys.argv[4])))
+    run(server.run(settings["roundStart"]))
+  elif config["Server"].get("Nodes"):
+    from io import StringIO
+    text = StringIO()
+    config.write(text)
+    nodeNames = [x.strip() for x in config["Server"]["Nodes"].split(",")]
+    run(Coordinator(settings["host"], settings["port"], config["Server"].get("ControlHost", settings["host"]), config["Server"].getint("ControlPort"), text.getvalue(), settings["games"], nodeNames).run())
+  elif settings["workers"] > 1:
+    run(ShardServer(settings["host"], settings["port"], sys.argv[1], settings["workers"], [x["id"] for x in settings["games"]], [x["ids"] for x in settings["games"]]).run())
+  else:
+    run(createServer(settings).run(settings["roundStart"]))